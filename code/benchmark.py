@@ -0,0 +1,475 @@
+import os
+import sys
+import csv
+import glob
+import json
+import math
+import random
+import shutil
+import logging
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+
+import ogr
+
+import osgbGrid
+
+# Pipeline stages timed by the benchmark, in run order
+stages = ["readOSMeridian2", "buildRiverNetwork", "readFlowData",
+          "snapStations", "calcUpstreamLength", "calcHeatProduction"]
+
+# Dataset count used to calculate the throughput of each stage
+stageItems = {"readOSMeridian2": "rivers",
+              "buildRiverNetwork": "rivers",
+              "readFlowData": "monthlyFlows",
+              "snapStations": "stations",
+              "calcUpstreamLength": "rivers",
+              "calcHeatProduction": "rivers"}
+
+# Synthetic network layout, units: meters
+edgeLength = 1000
+catchmentSpacing = 3000
+catchmentOrigin = 50000
+gridSquareSize = 100000
+
+
+def generateRiverNetwork(edgeCount, catchmentCount, rng):
+    """Generates dendritic river networks flowing west to a coastline, one
+       per catchment. Outlets are spaced north along a coast at x = 0, and
+       catchments beyond the northern edge of the OSGB grid squares wrap
+       into further columns to the east, each with its own coast. Each
+       network grows upstream from its outlet, with edges splitting into
+       one or two upstream edges. Returns list of edges in format of
+       [(identifier, (startX, startY), (endX, endY), depth)], where start
+       is the upstream end."""
+
+    edges = []
+    usedCoords = set()
+    maxOutletY = osgbGrid.gbRows * gridSquareSize - catchmentOrigin
+    coastX = 0
+    outletY = catchmentOrigin
+    columnMaxX = 0
+
+    def upstreamCoords(x, y):
+        while True:
+            coords = (x + edgeLength + rng.randint(-200, 200),
+                      y + rng.randint(-600, 600))
+            if coords not in usedCoords:
+                usedCoords.add(coords)
+                return coords
+
+    for c in range(catchmentCount):
+        budget = (edgeCount // catchmentCount +
+                  (1 if c < edgeCount % catchmentCount else 0))
+        if budget == 0:
+            continue
+
+        # Start a new column east of the previous one when it is full
+        if outletY > maxOutletY:
+            coastX = columnMaxX + catchmentSpacing
+            outletY = catchmentOrigin
+
+        outlet = (coastX, outletY)
+        outletY += catchmentSpacing
+        first = len(edges)
+        usedCoords.add(outlet)
+        source = upstreamCoords(*outlet)
+        edges.append((source, outlet, 0))
+        frontier = [(source, 1)]
+        budget -= 1
+        while budget > 0:
+            end, depth = frontier.pop(rng.randrange(len(frontier)))
+            for i in range(2 if rng.random() < 0.5 else 1):
+                if budget == 0:
+                    break
+                start = upstreamCoords(*end)
+                edges.append((start, end, depth))
+                frontier.append((start, depth + 1))
+                budget -= 1
+        columnMaxX = max(columnMaxX, max(e[0][0] for e in edges[first:]))
+
+    if columnMaxX >= osgbGrid.gbColumns * gridSquareSize:
+        raise ValueError("Network too large for OSGB grid squares")
+
+    return [("%013d" % (i + 1), start, end, depth)
+            for i, (start, end, depth) in enumerate(edges)]
+
+
+def createShapefile(path, geometryType, fields):
+    """Creates empty shapefile with fields in format of [(name, type)].
+       Returns data source and layer."""
+
+    driver = ogr.GetDriverByName("ESRI Shapefile")
+    dataSource = driver.CreateDataSource(path)
+    layer = dataSource.CreateLayer(
+        os.path.splitext(os.path.basename(path))[0], geom_type=geometryType
+    )
+    for name, fieldType in fields:
+        layer.CreateField(ogr.FieldDefn(name, fieldType))
+
+    return dataSource, layer
+
+
+def addFeature(layer, values, geometry):
+    """Adds feature with field values in format of {name: value}."""
+
+    feature = ogr.Feature(layer.GetLayerDefn())
+    for name, value in values.iteritems():
+        feature.SetField(name, value)
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+
+
+def lineGeometry(*points):
+    """Returns OGR line string through points."""
+
+    line = ogr.Geometry(ogr.wkbLineString)
+    for x, y in points:
+        line.AddPoint_2D(x, y)
+
+    return line
+
+
+def boxGeometry(minX, minY, maxX, maxY):
+    """Returns OGR polygon of box."""
+
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in ((minX, minY), (maxX, minY), (maxX, maxY), (minX, maxY),
+                 (minX, minY)):
+        ring.AddPoint_2D(x, y)
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    polygon.AddGeometry(ring)
+
+    return polygon
+
+
+def writeMeridian2(directory, edges, lakeEdges, rng):
+    """Writes synthetic OS Meridian 2 district, river, coastline and lake
+       shapefiles. A single Welsh district covers the whole network. Some
+       river lines are digitised against the direction of flow."""
+
+    maxX = max(e[1][0] for e in edges) + edgeLength
+    minY = min(min(e[1][1], e[2][1]) for e in edges) - edgeLength
+    maxY = max(max(e[1][1], e[2][1]) for e in edges) + edgeLength
+
+    dataSource, layer = createShapefile(
+        os.path.join(directory, "district_region.shp"), ogr.wkbPolygon,
+        [("NAME", ogr.OFTString)]
+    )
+    addFeature(layer, {"NAME": "POWYS - POWYS"},
+               boxGeometry(-edgeLength, minY, maxX, maxY))
+    dataSource = None
+
+    dataSource, layer = createShapefile(
+        os.path.join(directory, "river_polyline.shp"), ogr.wkbLineString,
+        [("IDENTIFIER", ogr.OFTString), ("CODE", ogr.OFTInteger),
+         ("NAME", ogr.OFTString)]
+    )
+    for identifier, start, end, depth in edges:
+        if identifier in lakeEdges:
+            code = 6232
+        else:
+            code = 6224 if depth < 3 else 6225
+        points = (start, end) if rng.random() < 0.7 else (end, start)
+        addFeature(layer,
+                   {"IDENTIFIER": identifier, "CODE": code,
+                    "NAME": "River %s" % identifier},
+                   lineGeometry(*points))
+    dataSource = None
+
+    dataSource, layer = createShapefile(
+        os.path.join(directory, "coast_ln_polyline.shp"), ogr.wkbLineString,
+        []
+    )
+    for coastX in sorted(set(e[2][0] for e in edges if e[3] == 0)):
+        addFeature(layer, {}, lineGeometry((coastX, minY), (coastX, maxY)))
+    dataSource = None
+
+    dataSource, layer = createShapefile(
+        os.path.join(directory, "lake_region.shp"), ogr.wkbPolygon,
+        [("IDENTIFIER", ogr.OFTString), ("CODE", ogr.OFTInteger),
+         ("NAME", ogr.OFTString)]
+    )
+    for identifier, start, end, depth in edges:
+        if identifier in lakeEdges:
+            x = (start[0] + end[0]) / 2.0
+            y = (start[1] + end[1]) / 2.0
+            addFeature(layer,
+                       {"IDENTIFIER": "L" + identifier, "CODE": 6202,
+                        "NAME": "Lake %s" % identifier},
+                       boxGeometry(x - 100, y - 100, x + 100, y + 100))
+    dataSource = None
+
+
+def writeFlowData(csvDir, lookupCsv, edges, stationCount, years, rng):
+    """Writes an NRFA style Gauged Monthly Flow csv file for each station,
+       with years of flows ending December 2013, and the lookup table
+       between station and river ids. Stations are placed on random edges.
+       Returns number of monthly flows."""
+
+    lastYear = 2013
+    firstYear = lastYear - years + 1
+    months = ["%04d-%02d" % (year, month)
+              for year in range(firstYear, lastYear + 1)
+              for month in range(1, 13)]
+
+    stations = rng.sample(edges, min(stationCount, len(edges)))
+    with open(lookupCsv, "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(["stationId", "riverId"])
+        for i, (identifier, start, end, depth) in enumerate(stations):
+            writer.writerow([100001 + i, identifier])
+
+    for i, (identifier, start, end, depth) in enumerate(stations):
+        stationId = 100001 + i
+        x = int((start[0] + end[0]) / 2.0 // 10 * 10)
+        y = int((start[1] + end[1]) / 2.0 // 10 * 10)
+        gridRef = "%s%04d%04d" % (osgbGrid.gridSquareCode(x, y),
+                                  x % gridSquareSize // 10,
+                                  y % gridSquareSize // 10)
+        scale = rng.uniform(0.5, 50.0)
+
+        with open(os.path.join(csvDir, "%d.csv" % stationId), "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(["file", "timestamp",
+                             datetime.datetime(2016, 1, 1).isoformat()])
+            writer.writerow(["database", "id", "nrfa-public"])
+            writer.writerow(["station", "id", stationId])
+            writer.writerow(["station", "name", "Station %d" % stationId])
+            writer.writerow(["station", "gridReference", gridRef])
+            writer.writerow(["dataType", "id", "gmf"])
+            writer.writerow(["dataType", "name", "Gauged Monthly Flow"])
+            writer.writerow(["dataType", "parameter", "Flow"])
+            writer.writerow(["dataType", "units", "m3/s"])
+            writer.writerow(["dataType", "period", "month"])
+            writer.writerow(["dataType", "measurementType", "Mean"])
+            writer.writerow(["data", "first", months[0]])
+            writer.writerow(["data", "last", months[-1]])
+            for month in months:
+                season = math.cos((int(month[5:]) - 1) * math.pi / 6)
+                flow = scale * (1.0 + 0.6 * season) * rng.uniform(0.7, 1.3)
+                writer.writerow([month, "%.3f" % flow])
+
+    return len(stations) * len(months)
+
+
+def generateDataset(root, args):
+    """Writes synthetic inputs under root/data, in the layout expected by
+       the pipeline scripts. Returns dictionary of dataset counts."""
+
+    rng = random.Random(args.seed)
+
+    meridian2Dir = os.path.join(root, "data", "meridian2_national_841398")
+    csvDir = os.path.join(root, "data", "nrfa", "NRFA Flow Data Retrieval")
+    for directory in (meridian2Dir, csvDir):
+        os.makedirs(directory)
+
+    logging.info("Generating river network of %d edges" % args.edges)
+    edges = generateRiverNetwork(args.edges, args.catchments, rng)
+    upstreamEdges = [e[0] for e in edges if e[3] > 0]
+    lakeEdges = set(rng.sample(upstreamEdges,
+                               min(args.lakes, len(upstreamEdges))))
+
+    logging.info("Writing shapefiles")
+    writeMeridian2(meridian2Dir, edges, lakeEdges, rng)
+
+    logging.info("Writing flow data for %d stations" % args.stations)
+    monthlyFlows = writeFlowData(
+        csvDir, os.path.join(root, "data", "riverStationLookup.csv"),
+        edges, args.stations, args.years, rng
+    )
+
+    return {"rivers": len(edges), "lakes": len(lakeEdges),
+            "stations": min(args.stations, len(edges)),
+            "monthlyFlows": monthlyFlows}
+
+
+def runStage(codeDir, script, scriptArgs):
+    """Runs script in codeDir, waiting with os.wait4 to collect resource
+       usage. Returns dictionary of return code, wall clock and CPU times,
+       and peak resident set size."""
+
+    started = datetime.datetime.now()
+    process = subprocess.Popen([sys.executable, script] + scriptArgs,
+                               cwd=codeDir)
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = (datetime.datetime.now() - started).total_seconds()
+    process.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                          else -os.WTERMSIG(status))
+
+    return {"returncode": process.returncode,
+            "seconds": seconds,
+            "userSeconds": usage.ru_utime,
+            "systemSeconds": usage.ru_stime,
+            "maxRssKiB": usage.ru_maxrss}  # Units: KiB on Linux
+
+
+def getCommit(directory):
+    """Returns git commit of directory, or None if not a git repository."""
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=directory).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareReports(report, previous, threshold):
+    """Prints ratio of stage times to those in previous report. Returns list
+       of stages more than threshold times slower."""
+
+    if report["parameters"] != previous["parameters"]:
+        logging.warning("Benchmark parameters differ from previous report")
+
+    previousStages = dict((s["name"], s) for s in previous["stages"])
+    regressions = []
+    print "%-20s %10s %10s %8s" % ("stage", "previous", "seconds", "ratio")
+    for stage in report["stages"]:
+        old = previousStages.get(stage["name"])
+        if (old is None or not old["seconds"] or old["returncode"] != 0 or
+                stage["returncode"] != 0):
+            continue
+        ratio = stage["seconds"] / old["seconds"]
+        flag = " REGRESSION" if ratio > threshold else ""
+        print "%-20s %10.2f %10.2f %8.2f%s" % (
+            stage["name"], old["seconds"], stage["seconds"], ratio, flag
+        )
+        if ratio > threshold:
+            regressions.append(stage["name"])
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Times the pipeline stages on synthetic river networks "
+                    "and flow data."
+    )
+    parser.add_argument("--edges", type=int, default=10000,
+                        help="number of river edges, default: 10000")
+    parser.add_argument("--catchments", type=int,
+                        help="number of catchments, default: one per 2000 "
+                             "edges")
+    parser.add_argument("--stations", type=int,
+                        help="number of gauging stations, default: one per "
+                             "200 edges")
+    parser.add_argument("--lakes", type=int,
+                        help="number of lakes, default: one per 500 edges")
+    parser.add_argument("--years", type=int, default=20,
+                        help="years of monthly flows per station, "
+                             "default: 20")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed, default: 0")
+    parser.add_argument("--stages", nargs="+", choices=stages,
+                        default=stages, help="stages to run, default: all")
+    parser.add_argument("--stage-args", action="append", default=[],
+                        metavar="STAGE=ARGS",
+                        help="extra command line arguments for a stage, "
+                             "e.g. readOSMeridian2=--parallel")
+    parser.add_argument("--output", default="benchmark.json",
+                        help="report file, default: benchmark.json")
+    parser.add_argument("--compare", metavar="REPORT",
+                        help="previous report to compare stage times with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown ratio reported as a regression, "
+                             "default: 1.2")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="also profile each stage, writing profiles "
+                             "to DIR (see profiling.py)")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the generated data and results")
+    args = parser.parse_args()
+    if args.catchments is None:
+        args.catchments = max(1, args.edges // 2000)
+    if args.stations is None:
+        args.stations = max(1, args.edges // 200)
+    if args.lakes is None:
+        args.lakes = args.edges // 500
+
+    # Snap every station, as the lookup table lists them all
+    stageArgs = dict((stage, []) for stage in stages)
+    stageArgs["snapStations"].append("--ignore-lookup")
+    for value in args.stage_args:
+        stage, extra = value.split("=", 1)
+        stageArgs[stage].extend(extra.split())
+
+    # Logging set-up
+    logging.basicConfig(format="%(asctime)s|%(levelname)s|%(message)s",
+                        level=logging.INFO)
+
+    # Copy scripts into a temporary tree next to the synthetic data
+    codeDir = os.path.dirname(os.path.abspath(__file__))
+    root = tempfile.mkdtemp(prefix="benchmark")
+    try:
+        os.makedirs(os.path.join(root, "code"))
+        os.makedirs(os.path.join(root, "results"))
+        for script in glob.glob(os.path.join(codeDir, "*.py")):
+            shutil.copy(script, os.path.join(root, "code"))
+
+        dataset = generateDataset(root, args)
+
+        report = {
+            "commit": getCommit(codeDir),
+            "created": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": {"edges": args.edges,
+                           "catchments": args.catchments,
+                           "stations": args.stations,
+                           "lakes": args.lakes,
+                           "years": args.years,
+                           "seed": args.seed,
+                           "stageArgs": stageArgs},
+            "dataset": dataset,
+            "stages": []
+        }
+
+        # Run stages in order, stopping at the first failure
+        if args.profile is not None:
+            os.environ["HEATMAP_PROFILE"] = os.path.abspath(args.profile)
+        for stage in stages:
+            if stage not in args.stages:
+                continue
+            logging.info("Running %s" % stage)
+            result = runStage(os.path.join(root, "code"), stage + ".py",
+                              stageArgs[stage])
+            result["name"] = stage
+            result["args"] = stageArgs[stage]
+            result["items"] = dataset[stageItems[stage]]
+            result["itemsPerSecond"] = (result["items"] / result["seconds"]
+                                        if result["seconds"] else None)
+            report["stages"].append(result)
+            if result["returncode"] != 0:
+                logging.error("%s failed with return code %d"
+                              % (stage, result["returncode"]))
+                break
+
+    finally:
+        if args.keep:
+            logging.info("Generated data and results kept in %s" % root)
+        else:
+            shutil.rmtree(root)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print "%-20s %10s %10s %12s %12s" % ("stage", "seconds", "cpu",
+                                         "items/s", "maxRssMiB")
+    for stage in report["stages"]:
+        print "%-20s %10.2f %10.2f %12.0f %12.1f" % (
+            stage["name"], stage["seconds"],
+            stage["userSeconds"] + stage["systemSeconds"],
+            stage["itemsPerSecond"] or 0, stage["maxRssKiB"] / 1024.0
+        )
+
+    regressions = []
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compareReports(report, json.load(f), args.threshold)
+
+    failed = [s for s in report["stages"] if s["returncode"] != 0]
+    sys.exit(1 if failed or regressions else 0)
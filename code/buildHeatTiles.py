@@ -0,0 +1,438 @@
+import math
+import zlib
+import struct
+import hashlib
+import logging
+import argparse
+import collections
+import multiprocessing
+
+import numpy
+import shapely.wkb
+
+import heatQuery
+import profiling
+
+# Tile pyramid on the British National Grid. Tiles are tileSize pixels
+# square, with the single tile of zoom level 0 covering originSize meters
+# north and east of the grid origin. Each zoom level halves tile size.
+tileSize = 256
+originSize = 1280000.0
+
+# Version of the rendering, recorded in tile hashes so changing how tiles
+# are drawn rebuilds them all
+renderVersion = "1"
+
+# Colour ramp of annual heat production, in format of
+# [(GWhPerYear, (red, green, blue))], interpolated on a log scale
+colourStops = [(0.01, (69, 117, 180)),
+               (0.1, (145, 191, 219)),
+               (1.0, (254, 224, 144)),
+               (10.0, (244, 109, 67)),
+               (100.0, (165, 0, 38))]
+
+# Width of river lines in pixels at each zoom level, from zoom 0
+lineWidths = [1, 1, 1, 1, 1, 1, 2, 2, 2, 3, 3, 3]
+
+
+def resolution(zoom):
+    """Returns size of a pixel at zoom level, units: meters."""
+
+    return originSize / tileSize / 2 ** zoom
+
+
+def heatColour(gwh):
+    """Returns array of RGB colours of annual heat production values."""
+
+    stops = numpy.log10([s[0] for s in colourStops])
+    colours = numpy.array([s[1] for s in colourStops], dtype=numpy.float64)
+    values = numpy.log10(numpy.maximum(gwh, colourStops[0][0]))
+
+    return numpy.column_stack([
+        numpy.interp(values, stops, colours[:, c]) for c in range(3)
+    ]).round().astype(numpy.uint8)
+
+
+def encodePng(rgba):
+    """Encodes array of height x width x 4 RGBA pixels as PNG."""
+
+    height, width = rgba.shape[:2]
+    scanlines = numpy.zeros((height, width * 4 + 1), dtype=numpy.uint8)
+    scanlines[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(chunkType, data):
+        return (struct.pack(">I", len(data)) + chunkType + data +
+                struct.pack(">I", zlib.crc32(chunkType + data) & 0xffffffff))
+
+    return ("\x89PNG\r\n\x1a\n" +
+            chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0,
+                                      0)) +
+            chunk("IDAT", zlib.compress(scanlines.tostring(), 6)) +
+            chunk("IEND", ""))
+
+
+def drawLine(image, coords, colour, width):
+    """Draws line through pixel coordinates on image, sampling each segment
+       every half pixel."""
+
+    start = coords[:-1]
+    step = coords[1:] - start
+    counts = numpy.ceil(numpy.hypot(step[:, 0], step[:, 1]) * 2).astype(
+        numpy.int64) + 1
+    fractions, segments = heatQuery.expandRanges(
+        numpy.zeros(len(counts), dtype=numpy.int64), counts
+    )
+    fractions = fractions / numpy.maximum(counts[segments] - 1, 1.0)
+    points = start[segments] + step[segments] * fractions[:, numpy.newaxis]
+
+    for dx in range(width):
+        for dy in range(width):
+            cols = numpy.floor(points[:, 0]).astype(numpy.int64) + dx
+            rows = numpy.floor(points[:, 1]).astype(numpy.int64) + dy
+            keep = ((cols >= 0) & (cols < tileSize) &
+                    (rows >= 0) & (rows < tileSize))
+            image[rows[keep], cols[keep], :3] = colour
+            image[rows[keep], cols[keep], 3] = 255
+
+
+def fillPolygon(image, rings, colour):
+    """Fills polygon with rings in pixel coordinates on image, testing the
+       centre of each pixel within its bounding box."""
+
+    allCoords = numpy.concatenate(rings)
+    minCol, minRow = numpy.maximum(
+        numpy.floor(allCoords.min(axis=0)).astype(numpy.int64), 0)
+    maxCol, maxRow = numpy.minimum(
+        numpy.ceil(allCoords.max(axis=0)).astype(numpy.int64), tileSize)
+    if minCol >= maxCol or minRow >= maxRow:
+        return
+
+    cols, rows = numpy.meshgrid(numpy.arange(minCol, maxCol),
+                                numpy.arange(minRow, maxRow))
+    px = cols.ravel() + 0.5
+    py = rows.ravel() + 0.5
+    crossings = numpy.zeros(len(px), dtype=numpy.int64)
+    for ring in rings:
+        for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+            if y1 == y2:
+                continue
+            spans = (y1 > py) != (y2 > py)
+            crossings += spans & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+
+    inside = crossings % 2 == 1
+    image[rows.ravel()[inside], cols.ravel()[inside], :3] = colour
+    image[rows.ravel()[inside], cols.ravel()[inside], 3] = 255
+
+
+def renderTile(task):
+    """Renders one tile as PNG. task is tuple of (zoom, column, row,
+       features), where features is list in format of
+       [(GWhPerYear, isPolygon, parts)] with parts as lists of arrays of
+       map coordinates, drawn in order. Returns tuple of (zoom, column,
+       row, png)."""
+
+    zoom, column, row, features = task
+    size = originSize / 2 ** zoom
+    pixel = resolution(zoom)
+    minX = column * size
+    maxY = (row + 1) * size
+
+    image = numpy.zeros((tileSize, tileSize, 4), dtype=numpy.uint8)
+    colours = heatColour(numpy.array([f[0] for f in features]))
+    width = lineWidths[min(zoom, len(lineWidths) - 1)]
+    for (gwh, isPolygon, parts), colour in zip(features, colours):
+        pixelParts = [numpy.column_stack(((p[:, 0] - minX) / pixel,
+                                          (maxY - p[:, 1]) / pixel))
+                      for p in parts]
+        if isPolygon:
+            fillPolygon(image, pixelParts, colour)
+        for p in pixelParts:
+            drawLine(image, p, colour, 1 if isPolygon else width)
+
+    return zoom, column, row, encodePng(image)
+
+
+def readHeatFeatures(cur):
+    """Reads features of annualHeat and annualHeatLakes tables. Returns
+       list in format of [(table, id, GWhPerYear, geometry, hash)], ordered
+       by GWhPerYear so larger producers are drawn last, where hash
+       identifies the feature's geometry and heat production."""
+
+    features = []
+    for table, idColumn in heatQuery.heatTables:
+        cur.execute("""SELECT %s, GWhPerYear, ST_AsBinary(geometry)
+                       FROM %s
+                       WHERE GWhPerYear IS NOT NULL
+                       AND geometry IS NOT NULL;""" % (idColumn, table))
+        for featureId, gwh, wkb in cur:
+            wkb = str(wkb)
+            features.append((table, featureId, gwh, shapely.wkb.loads(wkb),
+                             hashlib.sha1(table + repr(gwh) + wkb).digest()))
+    features.sort(key=lambda f: (f[2], f[0], f[1]))
+
+    return features
+
+
+def generalize(features, zoom):
+    """Simplifies features to the pixel size of zoom level. Returns list in
+       format of [(GWhPerYear, isPolygon, parts, bounds)]."""
+
+    tolerance = resolution(zoom)
+    generalized = []
+    for table, featureId, gwh, geometry, featureHash in features:
+        simplified = geometry.simplify(tolerance, preserve_topology=False)
+        if simplified.is_empty:
+            simplified = geometry
+        generalized.append((
+            gwh, geometry.geom_type in ("Polygon", "MultiPolygon"),
+            [p[:, :2] for p in heatQuery.geometryParts(simplified)],
+            simplified.bounds
+        ))
+
+    return generalized
+
+
+def tileFeatures(generalized, zoom):
+    """Assigns generalized features to every tile of zoom level they are
+       drawn on: tiles crossed by a line or polygon ring, allowing for line
+       width, and tiles inside a polygon. Returns dictionary in format of
+       {(column, row): [featureIndex]}."""
+
+    size = originSize / 2 ** zoom
+    margin = 3 * resolution(zoom)
+
+    # Segments of every line and polygon ring
+    parts = [(i, p) for i, f in enumerate(generalized) for p in f[2]]
+    featureOf = numpy.concatenate(
+        [numpy.zeros(0, dtype=numpy.int64)] +
+        [numpy.full(len(p) - 1, i, dtype=numpy.int64) for i, p in parts]
+    )
+    starts = numpy.concatenate([numpy.zeros((0, 2))] +
+                               [p[:-1] for i, p in parts])
+    ends = numpy.concatenate([numpy.zeros((0, 2))] + [p[1:] for i, p in parts])
+    x1, y1 = starts[:, 0], starts[:, 1]
+    x2, y2 = ends[:, 0], ends[:, 1]
+
+    # Tiles, grown by the margin, crossed by each segment: those overlapped
+    # by its bounding box without all corners on one side of its line
+    columns, rows, segments = heatQuery.boxCells(
+        numpy.minimum(x1, x2) - margin, numpy.minimum(y1, y2) - margin,
+        numpy.maximum(x1, x2) + margin, numpy.maximum(y1, y2) + margin, size
+    )
+    dx = (x2 - x1)[segments]
+    dy = (y2 - y1)[segments]
+    sides = sum(numpy.sign(dx * (cornerY - y1[segments]) -
+                           dy * (cornerX - x1[segments]))
+                for cornerX in (columns * size - margin,
+                                (columns + 1) * size + margin)
+                for cornerY in (rows * size - margin,
+                                (rows + 1) * size + margin))
+    crossed = numpy.abs(sides) < 4
+    features = [featureOf[segments[crossed]]]
+    columns = [columns[crossed]]
+    rows = [rows[crossed]]
+
+    # Tiles with their centre inside a polygon, counting ring crossings
+    # to the east of the centre
+    for i, (gwh, isPolygon, polygonParts, bounds) in enumerate(generalized):
+        if not isPolygon:
+            continue
+        minX, minY, maxX, maxY = numpy.array(bounds)[:, numpy.newaxis]
+        c, r, _ = heatQuery.boxCells(minX, minY, maxX, maxY, size)
+        centreX = ((c + 0.5) * size)[:, numpy.newaxis]
+        centreY = ((r + 0.5) * size)[:, numpy.newaxis]
+        crossings = 0
+        for p in polygonParts:
+            ax, ay, bx, by = p[:-1, 0], p[:-1, 1], p[1:, 0], p[1:, 1]
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                crossings = crossings + (
+                    ((ay > centreY) != (by > centreY)) &
+                    (centreX < ax + (centreY - ay) * (bx - ax) / (by - ay))
+                ).sum(axis=1)
+        inside = crossings % 2 == 1
+        features.append(numpy.full(inside.sum(), i, dtype=numpy.int64))
+        columns.append(c[inside])
+        rows.append(r[inside])
+
+    # Distinct features of each tile, in feature order
+    features = numpy.concatenate(features)
+    columns = numpy.concatenate(columns)
+    rows = numpy.concatenate(rows)
+    order = numpy.lexsort((features, rows, columns))
+    features = features[order]
+    columns = columns[order]
+    rows = rows[order]
+    first = numpy.ones(len(features), dtype=bool)
+    first[1:] = ((features[1:] != features[:-1]) | (rows[1:] != rows[:-1]) |
+                 (columns[1:] != columns[:-1]))
+
+    tiles = collections.defaultdict(list)
+    for column, row, i in zip(columns[first].tolist(), rows[first].tolist(),
+                              features[first].tolist()):
+        tiles[(column, row)].append(i)
+
+    return tiles
+
+
+def tileHash(features, indices, zoom):
+    """Returns hash of the features drawn on a tile."""
+
+    h = hashlib.sha1(renderVersion + str(zoom))
+    for i in indices:
+        h.update(features[i][4])
+
+    return h.hexdigest()
+
+
+def createTileTables(cur):
+    """Creates MBTiles tables and the tileHashes table, if they don't
+       already exist."""
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                   name TEXT PRIMARY KEY,
+                   value TEXT);""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS tiles (
+                   zoom_level INTEGER,
+                   tile_column INTEGER,
+                   tile_row INTEGER,
+                   tile_data BLOB,
+                   PRIMARY KEY (zoom_level, tile_column, tile_row));""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS tileHashes (
+                   zoom_level INTEGER,
+                   tile_column INTEGER,
+                   tile_row INTEGER,
+                   hash TEXT,
+                   PRIMARY KEY (zoom_level, tile_column, tile_row));""")
+
+
+def writeMetadata(cur, minZoom, maxZoom):
+    """Writes MBTiles metadata describing the tile pyramid."""
+
+    cur.executemany("""INSERT OR REPLACE INTO metadata (name, value)
+                       VALUES (?, ?);""",
+                    [("name", "Wales river heat"),
+                     ("format", "png"),
+                     ("type", "overlay"),
+                     ("description", "Annual heat production of rivers and "
+                                     "lakes, units: GWh per year"),
+                     ("minzoom", str(minZoom)),
+                     ("maxzoom", str(maxZoom)),
+                     ("crs", "EPSG:27700"),
+                     ("tileorigin", "0,0"),
+                     ("tilesize", str(tileSize)),
+                     ("originsize", str(originSize))])
+
+
+def getTileHashes(cur, zoom):
+    """Returns dictionary of stored tile hashes of zoom level in format of
+       {(column, row): hash}."""
+
+    cur.execute("""SELECT tile_column, tile_row, hash
+                   FROM tileHashes
+                   WHERE zoom_level = ?;""", (zoom,))
+
+    return dict(((row[0], row[1]), row[2]) for row in cur)
+
+
+def generateTasks(generalized, tiles, zoom):
+    """Yields renderTile tasks for tiles of zoom level."""
+
+    for (column, row), indices in tiles:
+        yield (zoom, column, row,
+               [generalized[i][:3] for i in indices])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Renders annual heat production of rivers and lakes to "
+                    "a pyramid of PNG tiles on the British National Grid, "
+                    "stored in an MBTiles file. Only tiles whose features "
+                    "changed since the last run are rendered."
+    )
+    parser.add_argument("--min-zoom", type=int, default=0,
+                        help="lowest zoom level, default: 0")
+    parser.add_argument("--max-zoom", type=int, default=9,
+                        help="highest zoom level, default: 9 (about 10 "
+                             "meters per pixel)")
+    parser.add_argument("--processes", type=int, metavar="N",
+                        help="number of worker processes, default: number "
+                             "of CPUs")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="render every tile, ignoring stored hashes")
+    args = parser.parse_args()
+
+    # Logging set-up
+    logging.basicConfig(format="%(asctime)s|%(levelname)s|%(message)s",
+                        level=logging.INFO)
+
+    # Database paths
+    sqliteDb = "../results/results.sqlite"
+    tilesDb = "../results/heatTiles.mbtiles"
+
+    # Read heat features
+    logging.info("Reading heat features")
+    profiling.stage("readHeatFeatures")
+    db = profiling.connect(sqliteDb)
+    try:
+        db.enable_load_extension(True)
+        db.load_extension("mod_spatialite")
+        features = readHeatFeatures(db.cursor())
+    finally:
+        db.close()
+
+    # Render changed tiles of each zoom level
+    tdb = profiling.connect(tilesDb)
+    try:
+        cur = tdb.cursor()
+        createTileTables(cur)
+        writeMetadata(cur, args.min_zoom, args.max_zoom)
+        cur.execute("""DELETE FROM tiles
+                       WHERE zoom_level < ? OR zoom_level > ?;""",
+                    (args.min_zoom, args.max_zoom))
+        cur.execute("""DELETE FROM tileHashes
+                       WHERE zoom_level < ? OR zoom_level > ?;""",
+                    (args.min_zoom, args.max_zoom))
+        pool = multiprocessing.Pool(args.processes)
+        try:
+            for zoom in range(args.min_zoom, args.max_zoom + 1):
+                profiling.stage("zoom%d" % zoom)
+                generalized = generalize(features, zoom)
+                tiles = tileFeatures(generalized, zoom)
+                hashes = dict((tile, tileHash(features, indices, zoom))
+                              for tile, indices in tiles.iteritems())
+                stored = getTileHashes(cur, zoom)
+
+                # Remove tiles no longer covering any features
+                removed = [(zoom,) + tile for tile in stored
+                           if tile not in hashes]
+                for table in ("tiles", "tileHashes"):
+                    cur.executemany("""DELETE FROM %s
+                                       WHERE zoom_level = ?
+                                       AND tile_column = ?
+                                       AND tile_row = ?;""" % table, removed)
+
+                changed = sorted((tile, indices)
+                                 for tile, indices in tiles.iteritems()
+                                 if args.rebuild or
+                                 stored.get(tile) != hashes[tile])
+                logging.info("Zoom %d: rendering %d of %d tiles, removing %d"
+                             % (zoom, len(changed), len(tiles), len(removed)))
+                for z, column, row, png in pool.imap_unordered(
+                        renderTile, generateTasks(generalized, changed, zoom)):
+                    cur.execute("""INSERT OR REPLACE INTO tiles
+                                   (zoom_level, tile_column, tile_row,
+                                   tile_data)
+                                   VALUES (?, ?, ?, ?);""",
+                                (z, column, row, buffer(png)))
+                    cur.execute("""INSERT OR REPLACE INTO tileHashes
+                                   (zoom_level, tile_column, tile_row, hash)
+                                   VALUES (?, ?, ?, ?);""",
+                                (z, column, row, hashes[(column, row)]))
+                tdb.commit()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    finally:
+        tdb.close()
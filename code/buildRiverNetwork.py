@@ -1,15 +1,129 @@
-import sqlite3
+import collections
 
+import graphSnapshot
+import profiling
 
-# Database path
-sqliteDb = "../results/results.sqlite"
 
-# Connect to database
-with sqlite3.connect(sqliteDb) as db:
-    db.enable_load_extension(True)
-    db.load_extension("mod_spatialite")
-    cur = db.cursor()
-    cur.execute("SELECT InitSpatialMetaData();")
+def getRiverEndpoints(cur):
+    """Reads the first and last vertex of every river line. Returns list in
+       format of [(rowId, (startX, startY), (endX, endY))]."""
+
+    cur.execute("""SELECT ROWID,
+                          ST_X(ST_StartPoint(geometry)),
+                          ST_Y(ST_StartPoint(geometry)),
+                          ST_X(ST_EndPoint(geometry)),
+                          ST_Y(ST_EndPoint(geometry))
+                   FROM osRivers;""")
+
+    return [(row[0], (row[1], row[2]), (row[3], row[4])) for row in cur]
+
+
+def findConnectedRivers(rivers, seedIds):
+    """Finds all river lines connected to the seed lines through shared
+       endpoints, using an index of lines by endpoint coordinates. rivers
+       is list in format of [(rowId, start, end)]. Returns sorted list of
+       rowIds, including the seeds."""
+
+    endpointIndex = collections.defaultdict(list)
+    for rowId, start, end in rivers:
+        endpointIndex[start].append(rowId)
+        endpointIndex[end].append(rowId)
+    endpoints = dict((rowId, (start, end)) for rowId, start, end in rivers)
+
+    found = set(seedIds)
+    queue = collections.deque(found)
+    while queue:
+        for coords in endpoints[queue.popleft()]:
+            for rowId in endpointIndex[coords]:
+                if rowId not in found:
+                    found.add(rowId)
+                    queue.append(rowId)
+
+    return sorted(found)
+
+
+def getEdgeEndpoints(cur):
+    """Reads the first and last vertex of every river edge. Returns list in
+       format of [(rowId, (startX, startY), (endX, endY))], ordered by
+       rowId."""
+
+    cur.execute("""SELECT ROWID, startX, startY, endX, endY
+                   FROM riverEdges
+                   ORDER BY ROWID;""")
+
+    return [(row[0], (row[1], row[2]), (row[3], row[4])) for row in cur]
+
+
+def getNodeCoords(cur):
+    """Reads river node coordinates. Returns list in format of
+       [(nodeId, (x, y))], ordered by nodeId."""
+
+    cur.execute("""SELECT id, x, y
+                   FROM riverNodes
+                   WHERE x IS NOT NULL
+                   ORDER BY id;""")
+
+    return [(row[0], (row[1], row[2])) for row in cur]
+
+
+def orientEdges(edges, nodes, nextNodeId):
+    """Works upstream from the existing nodes, one river order at a time,
+       orienting each edge in the direction of flow and creating a node at
+       its first vertex. Edges are snapped to nodes on exact coordinates,
+       and edges sharing a coordinate refer to the lowest node id there.
+       Returns list of new nodes in format of [(nodeId, (x, y))] and
+       dictionary in format of {rowId: (startNodeId, endNodeId, reverse)}."""
+
+    # Index nodes and edge endpoints by coordinates
+    nodeIndex = {}
+    for nodeId, coords in nodes:
+        nodeIndex.setdefault(coords, nodeId)
+
+    endpointIndex = collections.defaultdict(list)
+    for i, (rowId, start, end) in enumerate(edges):
+        endpointIndex[start].append(i)
+        if end != start:
+            endpointIndex[end].append(i)
+
+    newNodes = []
+    edgeNodes = {}
+    frontier = nodeIndex.keys()
+    while True:
+        # Find unoriented edges touching the newest nodes
+        found = sorted(set(
+            i for coords in frontier for i in endpointIndex.get(coords, [])
+            if edges[i][0] not in edgeNodes
+        ))
+        if not [i for i in found if edges[i][1] != edges[i][2]]:
+            break
+
+        # Reverse incorrectly orientated edges and find end nodes
+        oriented = []
+        for i in found:
+            rowId, start, end = edges[i]
+            reverse = start in nodeIndex
+            if reverse:
+                start, end = end, start
+            oriented.append((rowId, start, nodeIndex[end], reverse))
+
+        # Create nodes at first vertex of edges
+        frontier = []
+        for rowId, start, endNodeId, reverse in oriented:
+            newNodes.append((nextNodeId, start))
+            if start not in nodeIndex:
+                nodeIndex[start] = nextNodeId
+                frontier.append(start)
+            nextNodeId += 1
+
+        for rowId, start, endNodeId, reverse in oriented:
+            edgeNodes[rowId] = (nodeIndex[start], endNodeId, reverse)
+
+    return newNodes, edgeNodes
+
+
+def createRiverEdges(cur):
+    """Creates riverEdges table from river lines connected to rivers in
+       Wales, merging lines with the same identifier."""
 
     # Create table for river edges
     cur.execute("DROP TABLE IF EXISTS riverEdges;")
@@ -19,41 +133,66 @@ with sqlite3.connect(sqliteDb) as db:
                    startNodeId INTEGER,
                    endNodeId INTEGER,
                    nearestGaugedEdge TEXT,
-                   upstreamLengthRatio NUMERIC);""")
+                   upstreamLengthRatio NUMERIC,
+                   startX REAL,
+                   startY REAL,
+                   endX REAL,
+                   endY REAL);""")
     cur.execute("""SELECT AddGeometryColumn('riverEdges',
                                             'geometry',
                                             27700,
                                             'LINESTRING');""")
-    cur.execute("""WITH RECURSIVE
-                   results(identifier, code, geometry) AS
-                   (SELECT r.identifier, r.code, r.geometry
+
+    # Record a new build, so earlier graph snapshots are no longer current
+    graphSnapshot.newBuildId(cur)
+
+    # Find rivers connected to rivers in Wales
+    cur.execute("""SELECT r.ROWID
                    FROM osRivers r, wales w
                    WHERE ST_INTERSECTS(r.geometry, w.geometry)
                    AND r.ROWID IN
                    (SELECT ROWID
                    FROM SpatialIndex
                    WHERE f_table_name = 'osRivers'
-                   AND search_frame = w.geometry)
-                   UNION
-                   SELECT r.identifier, r.code, r.geometry
-                   FROM osRivers r, results s
-                   WHERE ST_INTERSECTS(r.geometry, s.geometry)
-                   AND r.ROWID IN
-                   (SELECT ROWID
-                   FROM SpatialIndex
-                   WHERE f_table_name = 'osRivers'
-                   AND search_frame = s.geometry))
-                   INSERT INTO riverEdges (id, code, geometry)
+                   AND search_frame = w.geometry);""")
+    walesRiverIds = [row[0] for row in cur]
+    riverIds = findConnectedRivers(getRiverEndpoints(cur), walesRiverIds)
+
+    cur.execute("DROP TABLE IF EXISTS temp.connectedRivers;")
+    cur.execute("""CREATE TEMP TABLE connectedRivers (
+                   riverRowId INTEGER PRIMARY KEY);""")
+    cur.executemany("INSERT INTO connectedRivers VALUES (?);",
+                    [(rowId,) for rowId in riverIds])
+
+    # Merge connected river lines into edges
+    cur.execute("""INSERT INTO riverEdges (id, code, geometry)
                    SELECT identifier, code,
-                          CastToLineString(ST_LineMerge(ST_Collect(geometry)))
-                   FROM results
+                          CastToLineString(
+                              ST_LineMerge(ST_Collect(geometry)))
+                   FROM osRivers
+                   WHERE ROWID IN
+                   (SELECT riverRowId FROM connectedRivers)
                    GROUP BY identifier, code;""")
     cur.execute("SELECT CreateSpatialIndex('riverEdges', 'geometry');")
 
+    # Store coordinates of first and last vertex
+    cur.execute("""UPDATE riverEdges
+                   SET startX = ST_X(ST_StartPoint(geometry)),
+                       startY = ST_Y(ST_StartPoint(geometry)),
+                       endX = ST_X(ST_EndPoint(geometry)),
+                       endY = ST_Y(ST_EndPoint(geometry));""")
+
+
+def createRiverNodes(cur):
+    """Creates riverNodes table with nodes where the coastline intersects
+       river edges."""
+
     # Create table for river nodes
     cur.execute("DROP TABLE IF EXISTS riverNodes;")
     cur.execute("""CREATE TABLE riverNodes (
-                   id INTEGER PRIMARY KEY);""")
+                   id INTEGER PRIMARY KEY,
+                   x REAL,
+                   y REAL);""")
     cur.execute("""SELECT AddGeometryColumn('riverNodes',
                                             'geometry',
                                             27700,
@@ -72,76 +211,66 @@ with sqlite3.connect(sqliteDb) as db:
                    GROUP BY e.geometry;""")
     cur.execute("SELECT CreateSpatialIndex('riverNodes', 'geometry');")
 
-    while cur.execute("""SELECT count(e.id)
-                         FROM riverEdges e, riverNodes n
-                         WHERE e.endNodeId IS NULL
-                         AND ST_Touches(e.geometry, n.geometry)
-                         AND e.ROWID IN
-                         (SELECT ROWID
-                         FROM SpatialIndex
-                         WHERE f_table_name = 'riverEdges'
-                         AND search_frame = n.geometry);""").fetchone()[0] > 0:
-
-        print cur.execute("""SELECT count(e.id)
-                         FROM riverEdges e, riverNodes n
-                         WHERE e.endNodeId IS NULL
-                         AND ST_Touches(e.geometry, n.geometry)
-                         AND e.ROWID IN
-                         (SELECT ROWID
-                         FROM SpatialIndex
-                         WHERE f_table_name = 'riverEdges'
-                         AND search_frame = n.geometry);""").fetchone()[0]
-
-        # Reverse incorrectly orientated linestrings
-        cur.execute("""UPDATE riverEdges
-                       SET geometry = ST_Reverse(geometry)
-                       WHERE id IN
-                       (SELECT e.id
-                       FROM riverEdges e, riverNodes n
-                       WHERE e.endNodeId IS NULL
-                       AND ST_Intersects(n.geometry,
-                                         ST_StartPoint(e.geometry))
-                       AND n.ROWID IN
-                       (SELECT ROWID
-                       FROM SpatialIndex
-                       WHERE f_table_name = 'riverNodes'
-                       AND search_frame = e.geometry));""")
-
-        # Set riverEdge endNodeId attribute
-        cur.execute("""UPDATE riverEdges
-                       SET endNodeId = (SELECT n.id
-                       FROM riverNodes n
-                       WHERE ST_Intersects(
-                           ST_EndPoint(riverEdges.geometry), n.geometry
-                       )
-                       AND n.ROWID IN
-                       (SELECT ROWID
-                       FROM SpatialIndex
-                       WHERE f_table_name = 'riverNodes'
-                       AND search_frame = riverEdges.geometry))
-                       WHERE endNodeId IS NULL;""")
-
-        # Create nodes at first vertex of riverEdge
-        cur.execute("""INSERT INTO riverNodes (geometry)
-                       SELECT ST_StartPoint(e.geometry)
-                       FROM riverEdges e
-                       WHERE e.startNodeId IS NULL
-                       AND e.endNodeId IS NOT NULL;""")
-
-        # Set riverEdge startNodeId attribute
-        cur.execute("""UPDATE riverEdges
-                       SET startNodeId = (SELECT n.id
-                       FROM riverNodes n
-                       WHERE ST_Intersects(
-                           ST_StartPoint(riverEdges.geometry), n.geometry
-                       )
-                       AND n.ROWID IN
-                       (SELECT ROWID
-                       FROM SpatialIndex
-                       WHERE f_table_name = 'riverNodes'
-                       AND search_frame = riverEdges.geometry))
-                       WHERE startNodeId IS NULL
-                       AND endNodeId IS NOT NULL;""")
-
-    # Commit changes
-    db.commit()
+    # Store node coordinates for matching edge endpoints
+    cur.execute("""UPDATE riverNodes
+                   SET x = ST_X(geometry), y = ST_Y(geometry);""")
+
+
+def writeOrientation(cur, newNodes, edgeNodes):
+    """Inserts nodes and sets river edge start and end nodes, reversing
+       edges where required. Takes the results of orientEdges."""
+
+    cur.executemany("""INSERT INTO riverNodes (id, x, y, geometry)
+                       VALUES (?, ?, ?, MakePoint(?, ?, 27700));""",
+                    [(id, x, y, x, y) for id, (x, y) in newNodes])
+    cur.executemany("""UPDATE riverEdges
+                       SET geometry = ST_Reverse(geometry),
+                           startX = endX, startY = endY,
+                           endX = startX, endY = startY
+                       WHERE ROWID = ?;""",
+                    [(rowId,) for rowId, (startNodeId, endNodeId, reverse)
+                     in edgeNodes.iteritems() if reverse])
+    cur.executemany("""UPDATE riverEdges
+                       SET startNodeId = ?, endNodeId = ?
+                       WHERE ROWID = ?;""",
+                    [(startNodeId, endNodeId, rowId)
+                     for rowId, (startNodeId, endNodeId, reverse)
+                     in edgeNodes.iteritems()])
+
+
+if __name__ == "__main__":
+
+    # Database path
+    sqliteDb = "../results/results.sqlite"
+
+    # Graph snapshot path
+    graphSnapshotDir = "../results/riverGraph"
+
+    # Connect to database
+    with profiling.connect(sqliteDb) as db:
+        db.enable_load_extension(True)
+        db.load_extension("mod_spatialite")
+        cur = db.cursor()
+        cur.execute("SELECT InitSpatialMetaData();")
+
+        # Create river edges and coastal nodes
+        profiling.stage("createRiverEdges")
+        createRiverEdges(cur)
+        createRiverNodes(cur)
+
+        # Orient edges in direction of flow and create upstream nodes
+        profiling.stage("orientEdges")
+        edges = getEdgeEndpoints(cur)
+        nodes = getNodeCoords(cur)
+        nextNodeId = cur.execute("""SELECT IFNULL(MAX(id), 0) + 1
+                                    FROM riverNodes;""").fetchone()[0]
+        newNodes, edgeNodes = orientEdges(edges, nodes, nextNodeId)
+
+        writeOrientation(cur, newNodes, edgeNodes)
+
+        # Commit changes
+        db.commit()
+
+        # Save graph snapshot for calcUpstreamLength.py
+        profiling.stage("writeGraphSnapshot")
+        graphSnapshot.writeGraphSnapshot(cur, graphSnapshotDir)
@@ -1,58 +1,203 @@
-import sqlite3
+import os
+import glob
+import argparse
+import collections
+import multiprocessing
 
-# Connect to sqlite database
-sqliteDb = "../results/results.sqlite"
-db = sqlite3.connect(sqliteDb)
-try:
-    db.enable_load_extension(True)
-    db.load_extension("mod_spatialite")
-    cur = db.cursor()
+import numpy
+import shapely.wkb
+import shapely.geometry
+import shapely.prepared
+
+import flowStore
+import heatModel
+import heatQuery
+import dailyFlows
+import profiling
+
+
+def createMonthlyFlowRates(cur):
+    """Creates empty monthlyFlowRates table."""
 
-    # Calculate mean monthly flow rate for last 5 years of data
     cur.execute("DROP TABLE IF EXISTS monthlyFlowRates;")
-    cur.execute("""CREATE TABLE monthlyFlowRates AS
-                   SELECT r.id AS riverId,
-                          STRFTIME("%m", gmf.month||"-01") AS month,
-                          AVG(gmf.flow) * r.upstreamLengthRatio AS flow,
-                          AVG(gmf.flow) * r.upstreamLengthRatio * 8.36
-                               AS heatMW,
-                          ST_Length(r.geometry) * 0.02 AS limitMW
-                   FROM nrfaStations s, nrfaData d, nrfaGmf gmf, riverEdges r
-                   WHERE d.station = s.id
-                   AND gmf.station = s.id
-                   AND s.riverId = r.nearestGaugedEdge
-                   AND DATE(first||"-01") <= DATE("2008-10-01")
-                   AND last = "2013-09"
-                   AND DATE(gmf.month||"-01")
-                       BETWEEN DATE("2008-10-01")
-                       AND DATE("2013-09-01")
-                   GROUP BY r.id, STRFTIME("%m", gmf.month||"-01");""")
-
-    # Calculate annual heat production in GWh per year
+    cur.execute("""CREATE TABLE monthlyFlowRates (
+                   riverId TEXT,
+                   month TEXT,
+                   flow REAL,
+                   heatMW REAL,
+                   limitMW REAL);""")
+
+
+def writeMonthlyFlowRates(cur, edgeIds, flow, heatMW, limitMW):
+    """Inserts monthly flows, heat and abstraction limits calculated by
+       heatModel.calcHeat for each river edge in edgeIds."""
+
+    edgeRows, months = numpy.nonzero(~numpy.isnan(flow))
+    cur.executemany(
+        "INSERT INTO monthlyFlowRates VALUES (?, ?, ?, ?, ?);",
+        [(edgeIds[i], "%02d" % (m + 1), flow[i, m], heatMW[i, m], limitMW[i])
+         for i, m in zip(edgeRows.tolist(), months.tolist())]
+    )
+
+
+def createDailyFlowStats(cur):
+    """Creates empty dailyFlowStats table."""
+
+    cur.execute("DROP TABLE IF EXISTS dailyFlowStats;")
+    cur.execute("""CREATE TABLE dailyFlowStats (
+                   riverId TEXT PRIMARY KEY,
+                   q95 REAL,
+                   q70 REAL,
+                   GWhPerYear REAL);""")
+
+
+def writeDailyFlowStats(cur, edgeIds, q95, q70, annualGWh):
+    """Inserts flows exceeded 95% and 70% of the time and annual heat
+       production calculated by heatModel.calcDailyHeat for each river edge
+       in edgeIds with flows."""
+
+    cur.executemany(
+        "INSERT INTO dailyFlowStats VALUES (?, ?, ?, ?);",
+        [(edgeId, q95[i], q70[i], annualGWh[i])
+         for i, edgeId in enumerate(edgeIds) if not numpy.isnan(q95[i])]
+    )
+
+
+def readDailyFlows(cur, csvDir, gauges, processes=1,
+                   start=heatModel.defaultStart, end=heatModel.defaultEnd):
+    """Streams Gauged Daily Flows csv files in csvDir once each,
+       accumulating statistics of the flows from start to end month at
+       every station. Returns list of dailyFlows.FlowAccumulator, or None,
+       for each gauged edge in list gauges."""
+
+    cur.execute("""SELECT id, riverId
+                   FROM nrfaStations
+                   WHERE riverId IS NOT NULL;""")
+    stationGauges = dict(cur.fetchall())
+
+    first, last = dailyFlows.periodDates(start, end)
+    tasks = [(csvFile, first, last)
+             for csvFile in sorted(glob.glob(os.path.join(csvDir, "*.csv")))]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            return dailyFlows.gaugeAccumulators(
+                pool.imap_unordered(dailyFlows.accumulateCsvWorker, tasks),
+                stationGauges, gauges
+            )
+        finally:
+            pool.close()
+            pool.join()
+
+    return dailyFlows.gaugeAccumulators(
+        (dailyFlows.accumulateCsv(*task) for task in tasks),
+        stationGauges, gauges
+    )
+
+
+def createAnnualHeat(cur):
+    """Creates empty annualHeat table. Its spatial index is created once
+       rows have been inserted."""
+
     cur.execute("DROP TABLE IF EXISTS annualHeat;")
     cur.execute("SELECT DisableSpatialIndex('annualHeat', 'geometry');")
-    cur.execute("""CREATE TABLE annualHeat (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                            riverId TEXT,
-                                            riverCode INTEGER,
-                                            GWhPerYear REAL);""")
+    cur.execute("""CREATE TABLE annualHeat (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   riverId TEXT,
+                   riverCode INTEGER,
+                   GWhPerYear REAL);""")
     cur.execute("""SELECT AddGeometryColumn('annualHeat',
                                             'geometry',
                                             27700,
                                             'LINESTRING');""")
-    cur.execute("""INSERT INTO annualHeat (riverId, riverCode, GWhPerYear, geometry)
-                   SELECT r.id, r.code, SUM(heatMW * 0.73), r.geometry
-                   FROM riverEdges r, monthlyFlowRates mf, wales w
-                   WHERE r.id = mf.riverId
-                   AND ST_INTERSECTS(r.geometry, w.geometry)
-                   AND r.ROWID IN
-                       (SELECT ROWID
-                       FROM SpatialIndex
-                       WHERE f_table_name = 'riverEdges'
-                       AND search_frame = w.geometry)
-                   GROUP BY r.id;""")
-    cur.execute("SELECT CreateSpatialIndex('annualHeat', 'geometry');")
-
-    # Calculate annual heat production for lakes
+
+
+def writeAnnualHeat(cur, edgeIds, annualGWh, includeIds):
+    """Inserts annual heat production of each river edge in edgeIds that is
+       in set includeIds and has flows, with the edge's code and
+       geometry."""
+
+    cur.executemany(
+        """INSERT INTO annualHeat (riverId, riverCode, GWhPerYear,
+                                  geometry)
+           SELECT id, code, ?, geometry
+           FROM riverEdges
+           WHERE id = ?;""",
+        [(annualGWh[i], edgeId) for i, edgeId in enumerate(edgeIds)
+         if edgeId in includeIds and not numpy.isnan(annualGWh[i])]
+    )
+
+
+def findLakeEdges(lakes, lakeBounds, edges, edgeBounds, cellSize=1000.0):
+    """Finds river edges intersecting each lake. Edge bounding boxes are
+       bucketed in a grid of cells, and only edges whose bounding boxes
+       overlap a lake's are tested against its prepared geometry. lakes and
+       edges are lists of Shapely geometries, with arrays of their bounding
+       boxes in format of [[minX, minY, maxX, maxY]]. Returns arrays of lake
+       and edge indices of each intersecting pair, ordered by lake."""
+
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    if not lakes or not edges:
+        return empty, empty
+
+    # Edges in the cells overlapped by each lake
+    edgeCells = heatQuery.bucketBoxes(edgeBounds[:, 0], edgeBounds[:, 1],
+                                      edgeBounds[:, 2], edgeBounds[:, 3],
+                                      cellSize)
+    cellX, cellY, cellLakes = heatQuery.boxCells(
+        lakeBounds[:, 0], lakeBounds[:, 1], lakeBounds[:, 2],
+        lakeBounds[:, 3], cellSize
+    )
+    candidates, cells = edgeCells.lookup(cellX, cellY)
+    pairs = numpy.unique(cellLakes[cells] * len(edges) + candidates)
+    lakeIndex = pairs // len(edges)
+    edgeIndex = pairs % len(edges)
+
+    # Candidates with overlapping bounding boxes
+    overlap = numpy.nonzero(
+        (edgeBounds[edgeIndex, 0] <= lakeBounds[lakeIndex, 2]) &
+        (edgeBounds[edgeIndex, 2] >= lakeBounds[lakeIndex, 0]) &
+        (edgeBounds[edgeIndex, 1] <= lakeBounds[lakeIndex, 3]) &
+        (edgeBounds[edgeIndex, 3] >= lakeBounds[lakeIndex, 1])
+    )[0]
+    lakeIndex = lakeIndex[overlap]
+    edgeIndex = edgeIndex[overlap]
+
+    # Test remaining candidates against prepared lake geometries
+    prepared = {}
+    intersects = numpy.zeros(len(lakeIndex), dtype=bool)
+    for i, (l, e) in enumerate(zip(lakeIndex.tolist(), edgeIndex.tolist())):
+        if l not in prepared:
+            prepared[l] = shapely.prepared.prep(lakes[l])
+        intersects[i] = prepared[l].intersects(edges[e])
+
+    return lakeIndex[intersects], edgeIndex[intersects]
+
+
+def edgeRole(lake, edge):
+    """Returns role of river edge intersecting prepared lake geometry, from
+       where its ends are: "inflow" if only its downstream end is in the
+       lake, "outflow" if only its upstream end is, "within" if both are and
+       "through" if neither is."""
+
+    upstream = lake.covers(shapely.geometry.Point(edge.coords[0]))
+    downstream = lake.covers(shapely.geometry.Point(edge.coords[-1]))
+    if upstream and downstream:
+        return "within"
+    if upstream:
+        return "outflow"
+    if downstream:
+        return "inflow"
+
+    return "through"
+
+
+def calcLakeHeat(cur, lakeEdges=False):
+    """Creates annualHeatLakes table with the annual heat production of the
+       largest river flowing through each lake. If lakeEdges, also creates
+       lakeRiverEdges table of the river edges flowing into, out of and
+       through each lake."""
+
     cur.execute("DROP TABLE IF EXISTS annualHeatLakes;")
     cur.execute("""CREATE TABLE annualHeatLakes (
                    id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -64,22 +209,134 @@ try:
                                             'geometry',
                                             27700,
                                             'POLYGON');""")
-    cur.execute("""INSERT INTO annualHeatLakes (identifier, code, name,
-                                                GWhPerYear, geometry)
-                   SELECT l.identifier, l.code, l.name, MAX(h.GWhPerYear),
-                          l.geometry
-                   FROM osLakes l, annualheat h
-                   WHERE h.riverCode = 6232
-                   AND ST_Intersects(l.geometry, h.geometry)
-                   AND l.ROWID IN
-                   (SELECT ROWID
-                   FROM SpatialIndex
-                   WHERE f_table_name = 'osLakes'
-                   AND search_frame = h.geometry)
-                   GROUP BY l.id;""")
+
+    # Read lakes and river heat edges
+    cur.execute("""SELECT id, identifier, ST_AsBinary(geometry),
+                          MbrMinX(geometry), MbrMinY(geometry),
+                          MbrMaxX(geometry), MbrMaxY(geometry)
+                   FROM osLakes
+                   WHERE geometry IS NOT NULL
+                   ORDER BY id;""")
+    lakes = [(row[0], row[1], shapely.wkb.loads(str(row[2])), row[3:])
+             for row in cur]
+    cur.execute("""SELECT riverId, GWhPerYear, ST_AsBinary(geometry),
+                          MbrMinX(geometry), MbrMinY(geometry),
+                          MbrMaxX(geometry), MbrMaxY(geometry)
+                   FROM annualHeat
+                   WHERE riverCode = 6232
+                   AND GWhPerYear IS NOT NULL;""")
+    edges = [(row[0], row[1], shapely.wkb.loads(str(row[2])), row[3:])
+             for row in cur]
+
+    # Find edges intersecting each lake
+    lakeIndex, edgeIndex = findLakeEdges(
+        [l[2] for l in lakes],
+        numpy.array([l[3] for l in lakes], dtype=numpy.float64),
+        [e[2] for e in edges],
+        numpy.array([e[3] for e in edges], dtype=numpy.float64)
+    )
+    maxGWh = collections.OrderedDict()
+    for l, e in zip(lakeIndex.tolist(), edgeIndex.tolist()):
+        maxGWh[l] = max(maxGWh.get(l, edges[e][1]), edges[e][1])
+
+    cur.executemany(
+        """INSERT INTO annualHeatLakes (identifier, code, name, GWhPerYear,
+                                        geometry)
+           SELECT identifier, code, name, ?, geometry
+           FROM osLakes
+           WHERE id = ?;""",
+        [(gwh, lakes[l][0]) for l, gwh in maxGWh.iteritems()]
+    )
     cur.execute("SELECT CreateSpatialIndex('annualHeatLakes', 'geometry');")
 
-finally:
-    # Commit changes and close database
-    db.commit()
-    db.close()
+    if lakeEdges:
+        cur.execute("DROP TABLE IF EXISTS lakeRiverEdges;")
+        cur.execute("""CREATE TABLE lakeRiverEdges (
+                       lakeId INTEGER,
+                       lakeIdentifier TEXT,
+                       riverId TEXT,
+                       role TEXT,
+                       GWhPerYear REAL);""")
+        prepared = {}
+        rows = []
+        for l, e in zip(lakeIndex.tolist(), edgeIndex.tolist()):
+            if l not in prepared:
+                prepared[l] = shapely.prepared.prep(lakes[l][2])
+            rows.append((lakes[l][0], lakes[l][1], edges[e][0],
+                         edgeRole(prepared[l], edges[e][2]), edges[e][1]))
+        cur.executemany("INSERT INTO lakeRiverEdges VALUES (?, ?, ?, ?, ?);",
+                        rows)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Calculates annual heat production of rivers and lakes."
+    )
+    parser.add_argument("--flow-store", metavar="DIR",
+                        help="read flows from columnar store in DIR")
+    parser.add_argument("--daily-flows", metavar="DIR",
+                        help="calculate heat from NRFA Gauged Daily Flow csv "
+                             "files in DIR, with daily heat capped by the "
+                             "abstraction limit")
+    parser.add_argument("--hands-off", type=float, metavar="PERCENT",
+                        help="with --daily-flows, only abstract flow above "
+                             "the flow exceeded PERCENT of the time, e.g. 95 "
+                             "for Q95")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes reading daily flow csv "
+                             "files")
+    parser.add_argument("--lake-edges", action="store_true",
+                        help="also write the river edges flowing into, out "
+                             "of and through each lake to the "
+                             "lakeRiverEdges table")
+    args = parser.parse_args()
+
+    # Connect to sqlite database
+    sqliteDb = "../results/results.sqlite"
+    db = profiling.connect(sqliteDb)
+    try:
+        db.enable_load_extension(True)
+        db.load_extension("mod_spatialite")
+        cur = db.cursor()
+
+        # Read river edges and gauged flows
+        profiling.stage("loadHeatInputs")
+        if args.daily_flows is not None:
+            store = None
+        elif args.flow_store is not None:
+            store = flowStore.FlowStore.load(args.flow_store)
+        else:
+            store = flowStore.FlowStore.fromDatabase(cur)
+        inputs = heatModel.loadHeatInputs(cur, store)
+
+        # Calculate mean monthly flow rate for last 5 years of data
+        profiling.stage("monthlyFlowRates")
+        if args.daily_flows is not None:
+            accumulators = readDailyFlows(cur, args.daily_flows,
+                                          inputs.gauges, args.processes)
+            flow, heatMW, limitMW, annualGWh, q95, q70 = \
+                heatModel.calcDailyHeat(inputs, accumulators,
+                                        handsOff=args.hands_off)
+            createDailyFlowStats(cur)
+            writeDailyFlowStats(cur, inputs.edgeIds, q95, q70, annualGWh)
+        else:
+            flow, heatMW, limitMW, annualGWh = heatModel.calcHeat(inputs)
+        createMonthlyFlowRates(cur)
+        writeMonthlyFlowRates(cur, inputs.edgeIds, flow, heatMW, limitMW)
+
+        # Calculate annual heat production in GWh per year
+        profiling.stage("annualHeat")
+        walesEdgeIds = heatModel.getWalesEdgeIds(cur)
+        createAnnualHeat(cur)
+        writeAnnualHeat(cur, inputs.edgeIds, annualGWh, walesEdgeIds)
+        cur.execute("SELECT CreateSpatialIndex('annualHeat', 'geometry');")
+
+        # Calculate annual heat production for lakes
+        profiling.stage("annualHeatLakes")
+        calcLakeHeat(cur, args.lake_edges)
+
+    finally:
+        # Commit changes and close database
+        db.commit()
+        db.close()
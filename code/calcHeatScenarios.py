@@ -0,0 +1,96 @@
+import csv
+import argparse
+
+import numpy
+
+import flowStore
+import heatModel
+import profiling
+
+# Scenario csv columns and their types. Blank values use the calcHeat
+# defaults.
+scenarioColumns = {
+    "start": str,
+    "end": str,
+    "heatFactor": float,
+    "limitFactor": float,
+    "gwhPerMWMonth": float,
+    "loadFactor": float,
+    "capToLimit": lambda v: v.strip().lower() in ("1", "true", "yes")
+}
+
+
+def readScenarios(scenarioCsv):
+    """Reads table of heat model parameter sets from csv file, with a
+       "scenario" column naming each set. Returns list in format of
+       [(scenario, {parameter: value})]."""
+
+    scenarios = []
+    with open(scenarioCsv, "rb") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            parameters = {}
+            for column, value in row.iteritems():
+                if column in scenarioColumns and value.strip() != "":
+                    parameters[column] = scenarioColumns[column](value)
+            scenarios.append((row["scenario"], parameters))
+
+    return scenarios
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Calculates annual heat production of rivers for each "
+                    "scenario in a csv file, with columns scenario, %s."
+                    % ", ".join(sorted(scenarioColumns))
+    )
+    parser.add_argument("scenarioCsv", help="csv file of scenarios")
+    parser.add_argument("--flow-store", metavar="DIR",
+                        help="read flows from columnar store in DIR")
+    args = parser.parse_args()
+
+    scenarios = readScenarios(args.scenarioCsv)
+
+    # Connect to sqlite database
+    sqliteDb = "../results/results.sqlite"
+    db = profiling.connect(sqliteDb)
+    try:
+        db.enable_load_extension(True)
+        db.load_extension("mod_spatialite")
+        cur = db.cursor()
+
+        # Read river edges and gauged flows once for all scenarios
+        profiling.stage("loadHeatInputs")
+        if args.flow_store is not None:
+            store = flowStore.FlowStore.load(args.flow_store)
+        else:
+            store = flowStore.FlowStore.fromDatabase(cur)
+        inputs = heatModel.loadHeatInputs(cur, store)
+        walesEdgeIds = heatModel.getWalesEdgeIds(cur)
+        walesEdges = numpy.array(
+            [edgeId in walesEdgeIds for edgeId in inputs.edgeIds], dtype=bool
+        )
+
+        # Calculate annual heat production in GWh per year
+        profiling.stage("annualHeatScenarios")
+        cur.execute("DROP TABLE IF EXISTS annualHeatScenarios;")
+        cur.execute("""CREATE TABLE annualHeatScenarios (
+                       scenario TEXT,
+                       riverId TEXT,
+                       GWhPerYear REAL);""")
+        for scenario, annualGWh in heatModel.calcScenarios(inputs,
+                                                            scenarios):
+            rows = numpy.nonzero(walesEdges & ~numpy.isnan(annualGWh))[0]
+            cur.executemany(
+                "INSERT INTO annualHeatScenarios VALUES (?, ?, ?);",
+                [(scenario, inputs.edgeIds[i], annualGWh[i])
+                 for i in rows.tolist()]
+            )
+        cur.execute("""CREATE INDEX annualHeatScenariosIdx
+                       ON annualHeatScenarios (scenario, riverId);""")
+
+    finally:
+        # Commit changes and close database
+        db.commit()
+        db.close()
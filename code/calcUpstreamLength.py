@@ -1,14 +1,16 @@
-import sqlite3
 import logging
+import heapq
 
-import networkx
-import shapely
-import shapely.wkt
+import numpy
 
+import graphSnapshot
+import profiling
+import riverGraph
 
-def searchUpOrDownStream(
-    graph, startNode, gaugedEdgeId, gaugedEdgeUpLen, searchDirection
-):
+
+def searchEdges(graph, startNode, searchDirection):
+    """Returns list of the edges next to those starting at startNode, in
+       the direction of the search."""
 
     if searchDirection == "upstream":
         # Find upstream edges
@@ -17,17 +19,177 @@ def searchUpOrDownStream(
         # Find downstream edges
         searchNodes = graph.successors(startNode)
 
-    searchEdges = graph.edges(searchNodes, keys=True, data=True)
-    for sEdge in searchEdges:
-        if sEdge[3].get("nearestGaugedEdge") is None:
-            sEdge[3]["nearestGaugedEdge"] = gaugedEdgeId
-            sEdge[3]["upstreamLengthRatio"] = (
-                sEdge[3]["upstreamLength"] / gaugedEdgeUpLen
-            )
+    return [e for n in searchNodes.tolist()
+            for e in graph.outEdgesOf(n).tolist()]
+
+
+def assignNearestGaugedEdges(graph, gaugedEdgeIds):
+    """Finds the nearest gauged edge for every edge connected to one, and
+       the ratio between their upstream lengths. Searches from all gauged
+       edges at once, first upstream then downstream, so an edge upstream of
+       a gauge is never assigned to one upstream of it. Distance is measured
+       along the river, with ties broken by gauged edge id. Sets the
+       nearestGaugedEdge and upstreamLengthRatio edge arrays."""
+
+    edgeIds = graph.edgeIds.tolist()
+    start = graph.start.tolist()
+    length = graph.length.tolist()
+    upstreamLength = graph.upstreamLength.tolist()
+    nearest = [-1] * len(edgeIds)
+    ratio = [float("nan")] * len(edgeIds)
+
+    gaugedEdgeIds = set(gaugedEdgeIds)
+    gEdges = sorted([i for i, edgeId in enumerate(edgeIds)
+                     if edgeId in gaugedEdgeIds],
+                    key=lambda i: edgeIds[i])
+
+    for g in gEdges:
+        nearest[g] = g
+        ratio[g] = 1.0
+
+    for searchDirection in ("upstream", "downstream"):
+
+        # Queue of (distance, gauged edge id, gauged edge, edge) ordered by
+        # distance from the gauged edge
+        queue = []
+        for g in gEdges:
+            for s in searchEdges(graph, start[g], searchDirection):
+                if nearest[s] < 0:
+                    heapq.heappush(queue, (length[s], edgeIds[g], g, s))
+
+        while queue:
+            distance, gEdgeId, g, e = heapq.heappop(queue)
+            if nearest[e] >= 0:
+                continue
+
+            nearest[e] = g
+            ratio[e] = upstreamLength[e] / upstreamLength[g]
+
+            for s in searchEdges(graph, start[e], searchDirection):
+                if nearest[s] < 0:
+                    heapq.heappush(
+                        queue, (distance + length[s], gEdgeId, g, s)
+                    )
+
+    graph.nearestGaugedEdge[:] = nearest
+    graph.upstreamLengthRatio[:] = ratio
+
+
+def calcUpstreamLengths(graph):
+    """Calculates the cumulative length of every edge and all edges upstream
+       of it. Visits the graph once in topological order, reusing the total
+       accumulated at each node. Sets the upstreamLength edge array."""
+
+    # Total length of edges leaving each node
+    outLength = numpy.bincount(graph.start, weights=graph.length,
+                               minlength=len(graph.nodeIds)).tolist()
+
+    order = graph.topologicalOrder()
+    if order is None:
+        # No topological order, search ancestors of every node instead
+        logging.warning("River network contains cycles")
+        nodeUpLen = [sum(outLength[n] for n in graph.ancestors(node))
+                     for node in range(len(graph.nodeIds))]
+    else:
+        # Upstream totals can only be added together where the upstream
+        # networks of a node's predecessors are disjoint. Each node is
+        # reached by walking upstream, nearest first, until the pending
+        # nodes are down to one, whose total then covers every node not yet
+        # walked. "Sealed" nodes, with a single successor and every node
+        # upstream only draining through them, are added with their totals
+        # without walking further. Walks only go beyond the predecessors
+        # where braided channels rejoin, and stop at the braid's
+        # bifurcation.
+        position = [0] * len(graph.nodeIds)
+        for i, node in enumerate(order.tolist()):
+            position[node] = i
+        start = graph.start.tolist()
+        end = graph.end.tolist()
+        inPointers = graph.inPointers.tolist()
+        inEdges = graph.inEdges.tolist()
+        outPointers = graph.outPointers.tolist()
+        outEdges = graph.outEdges.tolist()
+
+        def predecessors(node):
+            return set(start[e] for e in inEdges[inPointers[node]:
+                                                 inPointers[node + 1]])
+
+        def successors(node):
+            return set(end[e] for e in outEdges[outPointers[node]:
+                                               outPointers[node + 1]])
+
+        nodeUpLen = [0.0] * len(graph.nodeIds)
+        closed = [False] * len(graph.nodeIds)
+        sealed = [False] * len(graph.nodeIds)
+        for node in order.tolist():
+            upLen = 0.0
+            walked = set()
+            seen = set()
+            pending = []
+            unwalked = list(predecessors(node))
+            while True:
+                for p in unwalked:
+                    seen.add(p)
+                    if sealed[p]:
+                        upLen += outLength[p] + nodeUpLen[p]
+                    else:
+                        heapq.heappush(pending, (-position[p], p))
+
+                # Walk upstream until one pending node covers the rest
+                if len(pending) < 2:
+                    break
+                n = heapq.heappop(pending)[1]
+                walked.add(n)
+                upLen += outLength[n]
+                unwalked = predecessors(n) - seen
+
+            # Everything upstream drains through the node if every walked
+            # node and the last pending node only drain to walked nodes
+            inside = walked | set([node])
+            isClosed = all(successors(n) <= inside for n in walked)
+            if pending:
+                last = pending[0][1]
+                upLen += outLength[last] + nodeUpLen[last]
+                isClosed = (isClosed and closed[last] and
+                            successors(last) <= inside)
+
+            nodeUpLen[node] = upLen
+            closed[node] = isClosed
+            sealed[node] = isClosed and len(successors(node)) == 1
+
+    graph.upstreamLength[:] = (
+        graph.length + numpy.array(nodeUpLen)[graph.start]
+    )
+
+
+def writeEdgeResults(cur, results, clear=True):
+    """Sets nearestGaugedEdge and upstreamLengthRatio of river edges, and
+       clears them for edges without results unless clear is False.
+       results is list in format of
+       [(id, nearestGaugedEdge, upstreamLengthRatio)]. Results are staged
+       in a temporary table and applied with a single UPDATE."""
+
+    cur.execute("DROP TABLE IF EXISTS temp.edgeResults;")
+    cur.execute("""CREATE TEMP TABLE edgeResults (
+                   id TEXT PRIMARY KEY,
+                   nearestGaugedEdge TEXT,
+                   upstreamLengthRatio NUMERIC);""")
+    cur.executemany("INSERT INTO edgeResults VALUES (?, ?, ?);", results)
+    sql = """UPDATE riverEdges
+             SET nearestGaugedEdge =
+                 (SELECT r.nearestGaugedEdge
+                 FROM edgeResults r
+                 WHERE r.id = riverEdges.id),
+             upstreamLengthRatio =
+                 (SELECT r.upstreamLengthRatio
+                 FROM edgeResults r
+                 WHERE r.id = riverEdges.id)"""
+    if not clear:
+        sql += """
+             WHERE id IN (SELECT id FROM edgeResults)"""
+    cur.execute(sql + ";")
+    cur.execute("DROP TABLE temp.edgeResults;")
 
-            searchUpOrDownStream(
-                graph, sEdge[0], gaugedEdgeId, gaugedEdgeUpLen, searchDirection
-            )
 
 if __name__ == "__main__":
 
@@ -38,56 +200,35 @@ if __name__ == "__main__":
     # Database path
     sqliteDb = "../results/results.sqlite"
 
-    # Create Directed Graph with multiple edges
-    logging.info("Creating graph object")
-    G = networkx.MultiDiGraph()
+    # Graph snapshot path
+    graphSnapshotDir = "../results/riverGraph"
 
     # Connect to database
     logging.info("Connecting to database")
-    with sqlite3.connect(sqliteDb) as db:
+    with profiling.connect(sqliteDb) as db:
         db.enable_load_extension(True)
         db.load_extension("mod_spatialite")
         cur = db.cursor()
         cur.execute("SELECT InitSpatialMetaData(1);")
 
-        # Add river nodes to graph
-        logging.info("Adding river nodes to graph")
-        cur.execute("SELECT id, ST_ASText(geometry) from riverNodes;")
-        for row in cur:
-            id = row[0]
-            geometry = shapely.wkt.loads(row[1])
-
-            G.add_node(id, geometry=geometry)
-
-        # Add river edges to graph
-        logging.info("Adding river edges to graph")
-        cur.execute("""SELECT id, startNodeId, endNodeId, ST_ASText(geometry)
-                       FROM riverEdges
-                       WHERE startNodeId IS NOT NULL
-                       AND endNodeId IS NOT NULL;""")
-        for row in cur:
-            id = row[0]
-            startNodeId = row[1]
-            endNodeId = row[2]
-            geometry = shapely.wkt.loads(row[3])
-
-            G.add_edge(startNodeId, endNodeId, key=id, geometry=geometry)
+        # Create graph of river nodes and edges
+        profiling.stage("createGraph")
+        if graphSnapshot.isCurrent(cur, graphSnapshotDir):
+            logging.info("Creating graph from graph snapshot")
+            G = riverGraph.RiverGraph.fromSnapshot(
+                graphSnapshot.GraphSnapshot(graphSnapshotDir)
+            )
+        else:
+            logging.info("Creating graph from database")
+            G = riverGraph.RiverGraph.fromDatabase(cur)
 
         # Calculate upstream river length
         logging.info("Calculating upstream river lengths")
-        for startNode, endNode, key, attr in G.edges_iter(
-            data=True, keys=True
-        ):
-
-            preNodes = networkx.ancestors(G, startNode)
-            preEdges = G.edges(preNodes, keys=True, data=True)
-            upstreamLength = (
-                attr["geometry"].length +
-                sum([e[3]["geometry"].length for e in preEdges])
-            )
-            G.edge[startNode][endNode][key]["upstreamLength"] = upstreamLength
+        profiling.stage("calcUpstreamLengths")
+        calcUpstreamLengths(G)
 
         # Find river reaches with gauging station
+        profiling.stage("findGaugedEdges")
         cur.execute("""SELECT id
                        FROM riverEdges e
                        WHERE e.id IN
@@ -95,47 +236,21 @@ if __name__ == "__main__":
                        AND startNodeId IS NOT NULL
                        AND endNodeId IS NOT NULL;""")
         gEdgeIds = [row[0] for row in cur.fetchall()]
-        gEdges = [
-            e for e in G.edges(keys=True, data=True) if edge[2] in gEdgeIds
-        ]
-
-        for gEdge in gEdges:
-            gEdge[3]["nearestGaugedEdge"] = gEdge[2]
-            gEdge[3]["upstreamLengthRatio"] = 1
-
-        # Find upstream edges for each gauged edge
-        for gEdge in gEdges:
-            gEdgeStart = gEdge[0]
-            gEdgeId = gEdge[2]
-            gEdgeUpLen = gEdge[3]["upstreamLength"]
-
-            searchUpOrDownStream(
-                G, gEdgeStart, gEdgeId, gEdgeUpLen, "upstream"
-            )
 
-        # Find downstream edges for each gauged edge
-        for gEdge in gEdges:
-            gEdgeStart = gEdge[0]
-            gEdgeId = gEdge[2]
-            gEdgeUpLen = gEdge[3]["upstreamLength"]
-
-            searchUpOrDownStream(
-                G, gEdgeStart, gEdgeId, gEdgeUpLen, "downstream"
-            )
+        # Find nearest gauged edge for all other edges
+        logging.info("Finding nearest gauged edges")
+        profiling.stage("assignNearestGaugedEdges")
+        assignNearestGaugedEdges(G, gEdgeIds)
 
         # Update riverEdges tables
-        for e in G.edges_iter(data=True, keys=True):
-            if e[3].get("nearestGaugedEdge") is not None:
-                cur.execute("""
-                    UPDATE riverEdges
-                    SET nearestGaugedEdge = '%s',
-                    upstreamLengthRatio = %s
-                    WHERE id = '%s';
-                """ % (
-                    e[3].get("nearestGaugedEdge"),
-                    e[3].get("upstreamLengthRatio"),
-                    e[2]
-                ))
+        logging.info("Updating river edges")
+        profiling.stage("writeEdgeResults")
+        edgeIds = G.edgeIds.tolist()
+        writeEdgeResults(cur, [
+            (edgeIds[e], edgeIds[G.nearestGaugedEdge[e]],
+             float(G.upstreamLengthRatio[e]))
+            for e in numpy.nonzero(G.nearestGaugedEdge >= 0)[0].tolist()
+        ])
 
         # Commit changes
         db.commit()
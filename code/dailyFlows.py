@@ -0,0 +1,171 @@
+import datetime
+
+import numpy
+
+import readFlowData
+
+# Edges of the flow bins of station histograms, units: m3/s. Flows of 0 to
+# 0.0001 share the first bin, and bins are then evenly spaced on a log
+# scale, about 2% wide, with the last bin open ended.
+binEdges = numpy.r_[0.0, numpy.logspace(-4, 5, 901)]
+
+
+def periodDates(start, end):
+    """Returns first and last day of the period from start to end month, in
+       format of "YYYY-MM", as datetime.date."""
+
+    first = readFlowData.parseDate(start)
+    last = readFlowData.parseDate(end)
+    year, month = divmod(last.year * 12 + last.month, 12)
+
+    return first, datetime.date(year, month + 1, 1) - datetime.timedelta(1)
+
+
+class FlowAccumulator(object):
+    """Statistics of a series of daily flows, accumulated in a fixed amount
+       of memory as the series is read: sums and counts of flows in each
+       calendar month, and a histogram of flows with the count and sum of
+       the flows in each bin. Only flows from the first to the last day of
+       the period are counted. Accumulators of the same period can be
+       merged."""
+
+    def __init__(self, first, last):
+        self.first = first  # First day of period
+        self.last = last  # Last day of period
+        self.recordFirst = None  # First day of record
+        self.recordLast = None  # Last day of record
+        self.monthSums = numpy.zeros(12)
+        self.monthCounts = numpy.zeros(12, dtype=numpy.int64)
+        self.binCounts = numpy.zeros(len(binEdges), dtype=numpy.int64)
+        self.binSums = numpy.zeros(len(binEdges))
+
+    def add(self, flows):
+        """Adds list of daily flows in format of [(date, flow)], with
+           missing flows as None."""
+
+        if not flows:
+            return
+        dates = [f[0] for f in flows]
+        self.recordFirst = min([self.recordFirst or dates[0]] + dates)
+        self.recordLast = max([self.recordLast or dates[0]] + dates)
+
+        flow = numpy.array([f[1] for f in flows], dtype=numpy.float64)
+        counted = ~numpy.isnan(flow) & numpy.array(
+            [self.first <= d <= self.last for d in dates], dtype=bool
+        )
+        months = numpy.array([d.month - 1 for d in dates],
+                             dtype=numpy.int64)[counted]
+        flow = flow[counted]
+
+        self.monthSums += numpy.bincount(months, flow, minlength=12)
+        self.monthCounts += numpy.bincount(months, minlength=12)
+        bins = numpy.searchsorted(binEdges, flow, side="right") - 1
+        self.binCounts += numpy.bincount(bins, minlength=len(binEdges))
+        self.binSums += numpy.bincount(bins, flow, minlength=len(binEdges))
+
+    def merge(self, other):
+        """Adds the flows counted by another accumulator."""
+
+        for name in ("monthSums", "monthCounts", "binCounts", "binSums"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        firsts = [d for d in (self.recordFirst, other.recordFirst) if d]
+        lasts = [d for d in (self.recordLast, other.recordLast) if d]
+        self.recordFirst = min(firsts) if firsts else None
+        self.recordLast = max(lasts) if lasts else None
+
+    def covers(self):
+        """Returns whether the record covers the whole period."""
+
+        return (self.recordFirst is not None and
+                self.recordFirst <= self.first and
+                self.recordLast >= self.last)
+
+    def monthMeans(self):
+        """Returns array of mean flow of each calendar month, NaN where
+           there are no flows."""
+
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return numpy.where(self.monthCounts > 0,
+                               self.monthSums / self.monthCounts, numpy.nan)
+
+    def exceeded(self, percent):
+        """Returns flow exceeded percent of the time, e.g. Q95 for 95,
+           interpolated within its histogram bin. NaN without flows."""
+
+        total = self.binCounts.sum()
+        if total == 0:
+            return numpy.nan
+        rank = total * (100.0 - percent) / 100.0
+        cumulative = numpy.cumsum(self.binCounts)
+        b = min(int(numpy.searchsorted(cumulative, rank)), len(binEdges) - 1)
+        if b == len(binEdges) - 1:
+            return self.binSums[b] / self.binCounts[b]
+        below = cumulative[b] - self.binCounts[b]
+        fraction = (rank - below) / self.binCounts[b]
+
+        return binEdges[b] + fraction * (binEdges[b + 1] - binEdges[b])
+
+    def meanCapped(self, caps):
+        """Returns array of mean of daily flows capped at each flow in array
+           caps, min(flow, cap), using the mean flow of the histogram bin
+           containing the cap. NaN without flows."""
+
+        total = self.binCounts.sum()
+        caps = numpy.asarray(caps, dtype=numpy.float64)
+        if total == 0:
+            return numpy.full(caps.shape, numpy.nan)
+
+        cumCounts = numpy.r_[0, numpy.cumsum(self.binCounts)]
+        cumSums = numpy.r_[0.0, numpy.cumsum(self.binSums)]
+        b = numpy.searchsorted(binEdges, caps, side="right") - 1
+        b = numpy.clip(b, 0, len(binEdges) - 1)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            binMeans = numpy.where(self.binCounts[b] > 0,
+                                   self.binSums[b] / self.binCounts[b], 0.0)
+        above = total - cumCounts[b + 1]
+        capped = (cumSums[b] +
+                  numpy.minimum(binMeans, caps) * self.binCounts[b] +
+                  numpy.where(above > 0, caps, 0.0) * above)
+
+        return capped / total
+
+
+def accumulateCsv(gdfCsv, first, last, chunkSize=10000):
+    """Streams NRFA Gauged Daily Flows csv file, which has the same layout
+       as Gauged Monthly Flows files, through a FlowAccumulator. Returns
+       tuple of (station id, accumulator)."""
+
+    stream = readFlowData.streamGmfCsv(gdfCsv, chunkSize)
+    metadata = next(stream)
+    accumulator = FlowAccumulator(first, last)
+    for chunk in stream:
+        accumulator.add(chunk)
+
+    return int(metadata["station"]["id"]), accumulator
+
+
+def accumulateCsvWorker(task):
+    """Calls accumulateCsv in a worker process."""
+
+    return accumulateCsv(*task)
+
+
+def gaugeAccumulators(stationAccumulators, stationGauges, gauges):
+    """Merges accumulators of stations whose records cover the period by
+       gauged edge. stationAccumulators is iterable in format of
+       [(stationId, accumulator)] and stationGauges dictionary in format of
+       {stationId: gaugedEdgeId}. Returns list of an accumulator, or None
+       without covering stations, for each gauged edge in list gauges."""
+
+    gaugeIndex = dict((g, i) for i, g in enumerate(gauges))
+    merged = [None] * len(gauges)
+    for stationId, accumulator in stationAccumulators:
+        g = gaugeIndex.get(stationGauges.get(stationId))
+        if g is None or not accumulator.covers():
+            continue
+        if merged[g] is None:
+            merged[g] = accumulator
+        else:
+            merged[g].merge(accumulator)
+
+    return merged
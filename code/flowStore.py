@@ -0,0 +1,144 @@
+import os
+import json
+
+import numpy
+
+
+def monthOrdinal(month):
+    """Converts month in format of "YYYY-MM" to number of months since
+       year 0."""
+
+    year, month = month.split("-")[:2]
+
+    return int(year) * 12 + int(month) - 1
+
+
+def ordinalMonth(ordinal):
+    """Converts number of months since year 0 to month in format of
+       "YYYY-MM"."""
+
+    return "%04d-%02d" % (ordinal // 12, ordinal % 12 + 1)
+
+
+def nanMean(flows, axis):
+    """Returns mean of flows along axis ignoring NaN values, or NaN where
+       there are no values."""
+
+    counts = numpy.sum(~numpy.isnan(flows), axis=axis)
+    sums = numpy.nansum(flows, axis=axis)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return numpy.where(counts > 0, sums / counts, numpy.nan)
+
+
+class FlowStore(object):
+    """Gauged flows held in a 2D array with a row for each station and a
+       column for each month. Missing flows are NaN."""
+
+    def __init__(self, stations, firstMonth, flows):
+        self.stations = stations
+        self.firstMonth = firstMonth
+        self.flows = flows
+        self.rows = dict((s, i) for i, s in enumerate(stations.tolist()))
+
+    @classmethod
+    def fromDatabase(cls, cur, dtype=numpy.float64):
+        """Reads gauged monthly flows from nrfaGmf table."""
+
+        cur.execute("""SELECT station, month, flow
+                       FROM nrfaGmf
+                       WHERE flow IS NOT NULL;""")
+        rows = [(station, monthOrdinal(month), flow)
+                for station, month, flow in cur]
+
+        stations = numpy.array(sorted(set(r[0] for r in rows)),
+                               dtype=numpy.int64)
+        if rows:
+            firstMonth = min(r[1] for r in rows)
+            lastMonth = max(r[1] for r in rows)
+        else:
+            firstMonth = lastMonth = 0
+
+        flows = numpy.full((len(stations), lastMonth - firstMonth + 1),
+                           numpy.nan, dtype=dtype)
+        if rows:
+            stationRows = numpy.searchsorted(
+                stations, numpy.array([r[0] for r in rows], dtype=numpy.int64)
+            )
+            monthCols = numpy.array([r[1] for r in rows]) - firstMonth
+            flows[stationRows, monthCols] = [r[2] for r in rows]
+
+        return cls(stations, firstMonth, flows)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Loads store saved in directory, memory-mapping the flows array
+           unless mmap is False."""
+
+        with open(os.path.join(directory, "flowStore.json")) as f:
+            metadata = json.load(f)
+        stations = numpy.load(os.path.join(directory, "stations.npy"))
+        flows = numpy.load(os.path.join(directory, "flows.npy"),
+                           mmap_mode="r" if mmap else None)
+
+        return cls(stations, metadata["firstMonth"], flows)
+
+    def save(self, directory):
+        """Saves store to directory as .npy files."""
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        numpy.save(os.path.join(directory, "stations.npy"), self.stations)
+        numpy.save(os.path.join(directory, "flows.npy"), self.flows)
+        with open(os.path.join(directory, "flowStore.json"), "w") as f:
+            json.dump({"firstMonth": self.firstMonth,
+                       "lastMonth": self.firstMonth + self.flows.shape[1] - 1,
+                       "dtype": str(self.flows.dtype)}, f)
+
+    def window(self, start, end):
+        """Returns array of flows for all stations from start to end month
+           inclusive, in format of "YYYY-MM". Months outside the store are
+           NaN."""
+
+        first = monthOrdinal(start) - self.firstMonth
+        last = monthOrdinal(end) - self.firstMonth
+        if first >= 0 and last < self.flows.shape[1]:
+            return self.flows[:, first:last + 1]
+
+        window = numpy.full((len(self.stations), last - first + 1),
+                            numpy.nan, dtype=self.flows.dtype)
+        lo = max(first, 0)
+        hi = min(last + 1, self.flows.shape[1])
+        if lo < hi:
+            window[:, lo - first:hi - first] = self.flows[:, lo:hi]
+
+        return window
+
+    def windowMean(self, start, end):
+        """Returns mean flow of each station from start to end month."""
+
+        return nanMean(self.window(start, end), axis=1)
+
+    def calendarMonthTotals(self, start, end):
+        """Returns arrays of the sum and count of flows from start to end
+           month, with a row for each station and a column for each
+           calendar month, January first."""
+
+        window = self.window(start, end)
+        startMonth = monthOrdinal(start) % 12
+        sums = numpy.zeros((len(self.stations), 12))
+        counts = numpy.zeros((len(self.stations), 12), dtype=numpy.int64)
+        for month in range(12):
+            flows = window[:, (month - startMonth) % 12::12]
+            sums[:, month] = numpy.nansum(flows, axis=1)
+            counts[:, month] = numpy.sum(~numpy.isnan(flows), axis=1)
+
+        return sums, counts
+
+    def calendarMonthMeans(self, start, end):
+        """Returns array with a row for each station and a column for each
+           calendar month, January first, holding the mean flow of that
+           month from start to end month. NaN where there are no flows."""
+
+        sums, counts = self.calendarMonthTotals(start, end)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return numpy.where(counts > 0, sums / counts, numpy.nan)
@@ -0,0 +1,112 @@
+import os
+import json
+import uuid
+import sqlite3
+
+import numpy
+import shapely.wkb
+
+
+def writeGraphSnapshot(cur, directory):
+    """Reads river nodes and river edges with start and end nodes, and
+       saves them to directory as .npy arrays: node ids, edge start and end
+       node ids, edge ids, edge lengths, and edge geometries as
+       concatenated WKB with offsets."""
+
+    cur.execute("SELECT id FROM riverNodes ORDER BY id;")
+    nodeIds = numpy.array([row[0] for row in cur], dtype=numpy.int64)
+
+    cur.execute("""SELECT id, startNodeId, endNodeId, ST_Length(geometry),
+                          ST_AsBinary(geometry)
+                   FROM riverEdges
+                   WHERE startNodeId IS NOT NULL
+                   AND endNodeId IS NOT NULL
+                   ORDER BY ROWID;""")
+    edges = cur.fetchall()
+
+    geometries = [str(e[4]) for e in edges]
+    offsets = numpy.zeros(len(edges) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(g) for g in geometries])
+
+    arrays = {
+        "nodeIds": nodeIds,
+        "edgeIds": numpy.array([e[0].encode("utf-8") for e in edges],
+                               dtype=bytes),
+        "edgeStart": numpy.array([e[1] for e in edges], dtype=numpy.int64),
+        "edgeEnd": numpy.array([e[2] for e in edges], dtype=numpy.int64),
+        "edgeLength": numpy.array([e[3] for e in edges],
+                                  dtype=numpy.float64),
+        "geometryOffsets": offsets,
+        "geometries": numpy.frombuffer("".join(geometries), dtype=numpy.uint8)
+    }
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name, array in arrays.iteritems():
+        numpy.save(os.path.join(directory, name + ".npy"), array)
+    with open(os.path.join(directory, "graphSnapshot.json"), "w") as f:
+        json.dump({"nodes": len(nodeIds), "edges": len(edges),
+                   "buildId": getBuildId(cur)}, f)
+
+
+class GraphSnapshot(object):
+    """River network saved by writeGraphSnapshot, with arrays
+       memory-mapped. Edge geometries are only decoded when requested."""
+
+    def __init__(self, directory, mmap=True):
+        with open(os.path.join(directory, "graphSnapshot.json")) as f:
+            metadata = json.load(f)
+        self.nodeCount = metadata["nodes"]
+        self.edgeCount = metadata["edges"]
+
+        mmapMode = "r" if mmap else None
+        for name in ("nodeIds", "edgeIds", "edgeStart", "edgeEnd",
+                     "edgeLength", "geometryOffsets", "geometries"):
+            setattr(self, name, numpy.load(
+                os.path.join(directory, name + ".npy"), mmap_mode=mmapMode
+            ))
+
+    def geometry(self, i):
+        """Returns Shapely geometry of the edge at index i."""
+
+        start = self.geometryOffsets[i]
+        end = self.geometryOffsets[i + 1]
+
+        return shapely.wkb.loads(self.geometries[start:end].tostring())
+
+
+def newBuildId(cur):
+    """Records a new build id of the river network in the riverNetworkBuild
+       table. Called whenever river edges are recreated, so that snapshots
+       of earlier builds are no longer current."""
+
+    cur.execute("DROP TABLE IF EXISTS riverNetworkBuild;")
+    cur.execute("CREATE TABLE riverNetworkBuild (buildId TEXT);")
+    cur.execute("INSERT INTO riverNetworkBuild VALUES (?);",
+                (uuid.uuid4().hex,))
+
+
+def getBuildId(cur):
+    """Returns build id of the river network in the database, or None."""
+
+    try:
+        row = cur.execute("SELECT buildId FROM riverNetworkBuild;").fetchone()
+    except sqlite3.OperationalError:
+        return None
+
+    return row[0] if row is not None else None
+
+
+def isCurrent(cur, directory):
+    """Returns True if a snapshot exists in directory of the same build of
+       the river network as the database."""
+
+    metadataJson = os.path.join(directory, "graphSnapshot.json")
+    if not os.path.exists(metadataJson):
+        return False
+
+    with open(metadataJson) as f:
+        metadata = json.load(f)
+    buildId = metadata.get("buildId")
+
+    return buildId is not None and buildId == getBuildId(cur)
@@ -0,0 +1,236 @@
+import numpy
+
+# Period of gauged flows used by default
+defaultStart = "2008-10"
+defaultEnd = "2013-09"
+
+
+class HeatInputs(object):
+    """River edges with a nearest gauged edge, and the gauging stations on
+       those gauged edges, held in arrays for the heat model."""
+
+    def __init__(self, edgeIds, codes, gaugeIndex, ratios, lengths,
+                 gauges, stationGauges, stationRows, firsts, lasts, store):
+        self.edgeIds = edgeIds  # River edge ids
+        self.codes = codes  # River edge codes
+        self.gaugeIndex = gaugeIndex  # Index of each edge's gauged edge
+        self.ratios = ratios  # Upstream length ratio of each edge
+        self.lengths = lengths  # Length of each edge, units: meters
+        self.gauges = gauges  # Gauged edge ids
+        self.stationGauges = stationGauges  # Gauged edge index of stations
+        self.stationRows = stationRows  # Flow store row of stations
+        self.firsts = firsts  # First month of station records
+        self.lasts = lasts  # Last month of station records
+        self.store = store  # Flow store
+
+
+def loadHeatInputs(cur, store):
+    """Reads river edges with a nearest gauged edge, and the records of
+       gauging stations on those gauged edges. Returns HeatInputs. Station
+       records are left out if store is None."""
+
+    cur.execute("""SELECT id, code, nearestGaugedEdge, upstreamLengthRatio,
+                          ST_Length(geometry)
+                   FROM riverEdges
+                   WHERE nearestGaugedEdge IS NOT NULL
+                   AND upstreamLengthRatio IS NOT NULL
+                   ORDER BY id;""")
+    edges = cur.fetchall()
+
+    gauges = sorted(set(e[2] for e in edges))
+    gaugeIndex = dict((g, i) for i, g in enumerate(gauges))
+
+    return HeatInputs(
+        [e[0] for e in edges],
+        numpy.array([e[1] for e in edges], dtype=numpy.int64),
+        numpy.array([gaugeIndex[e[2]] for e in edges], dtype=numpy.int64),
+        numpy.array([e[3] for e in edges], dtype=numpy.float64),
+        numpy.array([e[4] for e in edges], dtype=numpy.float64),
+        gauges,
+        *(loadStations(cur, gauges, store) if store is not None
+          else (None,) * 5)
+    )
+
+
+def loadStations(cur, gauges, store):
+    """Reads the records of gauging stations on the gauged edges in list
+       gauges. Returns the HeatInputs station arguments: stationGauges,
+       stationRows, firsts, lasts and store."""
+
+    gaugeIndex = dict((g, i) for i, g in enumerate(gauges))
+
+    cur.execute("""SELECT s.id, s.riverId, d.first, d.last
+                   FROM nrfaStations s, nrfaData d
+                   WHERE d.station = s.id
+                   AND s.riverId IS NOT NULL;""")
+    stations = [row for row in cur
+                if row[1] in gaugeIndex and row[0] in store.rows]
+
+    return (
+        numpy.array([gaugeIndex[s[1]] for s in stations], dtype=numpy.int64),
+        numpy.array([store.rows[s[0]] for s in stations], dtype=numpy.int64),
+        [s[2] for s in stations],
+        [s[3] for s in stations],
+        store
+    )
+
+
+def calcGaugeMonthlyFlows(inputs, start, end):
+    """Calculates mean flow of each calendar month from start to end month,
+       in format of "YYYY-MM", at each gauged edge. Only stations with
+       records covering the whole period are used. Returns array with a row
+       for each gauged edge and a column for each calendar month, NaN where
+       there are no flows."""
+
+    covered = numpy.array(
+        [first <= start and last >= end
+         for first, last in zip(inputs.firsts, inputs.lasts)],
+        dtype=bool
+    )
+
+    stationSums, stationCounts = inputs.store.calendarMonthTotals(start, end)
+    sums = numpy.zeros((len(inputs.gauges), 12))
+    counts = numpy.zeros((len(inputs.gauges), 12), dtype=numpy.int64)
+    if covered.any():
+        rows = inputs.stationRows[covered]
+        numpy.add.at(sums, inputs.stationGauges[covered], stationSums[rows])
+        numpy.add.at(counts, inputs.stationGauges[covered],
+                     stationCounts[rows])
+
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return numpy.where(counts > 0, sums / counts, numpy.nan)
+
+
+def calcHeat(inputs, start=defaultStart, end=defaultEnd, heatFactor=8.36,
+             limitFactor=0.02, gwhPerMWMonth=0.73, loadFactor=1.0,
+             capToLimit=False, gaugeFlows=None):
+    """Calculates heat production of every river edge from the mean monthly
+       flows at its nearest gauged edge, scaled by upstream length ratio.
+
+       heatFactor: heat extracted per unit flow, units: MW/(m3/s). 8.36
+                   assumes a river temperature change of 2 degrees Celsius
+       limitFactor: abstraction limit per length of river, units: MW/m
+       gwhPerMWMonth: energy produced by 1 MW over a month, units: GWh
+       loadFactor: fraction of the month heat is extracted
+       capToLimit: whether monthly heat is capped by the abstraction limit
+       gaugeFlows: precalculated result of calcGaugeMonthlyFlows
+
+       Returns monthly flow (m3/s) and heat (MW) arrays with a row for each
+       edge and a column for each calendar month, an array of abstraction
+       limits (MW), and an array of annual heat production (GWh/year). NaN
+       where there are no flows."""
+
+    if gaugeFlows is None:
+        gaugeFlows = calcGaugeMonthlyFlows(inputs, start, end)
+
+    flow = gaugeFlows[inputs.gaugeIndex] * inputs.ratios[:, numpy.newaxis]
+    heatMW = flow * heatFactor
+    limitMW = inputs.lengths * limitFactor
+    if capToLimit:
+        heatMW = numpy.minimum(heatMW, limitMW[:, numpy.newaxis])
+
+    hasFlow = ~numpy.isnan(heatMW)
+    annualGWh = numpy.where(
+        hasFlow.any(axis=1),
+        numpy.nansum(heatMW, axis=1) * gwhPerMWMonth * loadFactor,
+        numpy.nan
+    )
+
+    return flow, heatMW, limitMW, annualGWh
+
+
+def calcDailyHeat(inputs, gaugeAccumulators, heatFactor=8.36,
+                  limitFactor=0.02, gwhPerMWYear=8.76, loadFactor=1.0,
+                  capToLimit=True, handsOff=None):
+    """Calculates heat production of every river edge from daily flows at
+       its nearest gauged edge, scaled by upstream length ratio. Parameters
+       are as for calcHeat, with gaugeAccumulators a list of
+       dailyFlows.FlowAccumulator, or None, for each gauged edge.
+
+       gwhPerMWYear: energy produced by 1 MW over a year, units: GWh
+       capToLimit: whether daily heat is capped by the abstraction limit
+       handsOff: percent of time exceeded of the hands-off flow, e.g. 95 for
+                 Q95. Only flow above the hands-off flow is abstracted
+
+       Returns monthly flow (m3/s) and heat (MW) arrays as calcHeat does, an
+       array of abstraction limits (MW), an array of annual heat production
+       (GWh/year) from the mean of daily heat, and arrays of Q95 and Q70
+       flows (m3/s). NaN where there are no flows."""
+
+    gaugeFlows = numpy.full((len(inputs.gauges), 12), numpy.nan)
+    q95 = numpy.full(len(inputs.gauges), numpy.nan)
+    q70 = numpy.full(len(inputs.gauges), numpy.nan)
+    for g, accumulator in enumerate(gaugeAccumulators):
+        if accumulator is not None:
+            gaugeFlows[g] = accumulator.monthMeans()
+            q95[g] = accumulator.exceeded(95)
+            q70[g] = accumulator.exceeded(70)
+
+    flow, heatMW, limitMW, annualGWh = calcHeat(
+        inputs, heatFactor=heatFactor, limitFactor=limitFactor,
+        capToLimit=capToLimit, gaugeFlows=gaugeFlows
+    )
+
+    # Mean daily flow abstracted at each edge, in terms of gauged flow: the
+    # flow above the hands-off flow, up to the abstraction limit
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        caps = numpy.where(capToLimit,
+                           limitMW / (heatFactor * inputs.ratios), numpy.inf)
+    meanFlow = numpy.full(len(inputs.ratios), numpy.nan)
+
+    # Edges of each gauge, grouped once
+    order = numpy.argsort(inputs.gaugeIndex, kind="mergesort")
+    bounds = numpy.searchsorted(inputs.gaugeIndex[order],
+                                numpy.arange(len(inputs.gauges) + 1))
+    for g, accumulator in enumerate(gaugeAccumulators):
+        if accumulator is None:
+            continue
+        edges = order[bounds[g]:bounds[g + 1]]
+        if handsOff is None:
+            meanFlow[edges] = accumulator.meanCapped(caps[edges])
+        else:
+            threshold = accumulator.exceeded(handsOff)
+            meanFlow[edges] = (
+                accumulator.meanCapped(threshold + caps[edges]) -
+                accumulator.meanCapped(numpy.full(len(edges), threshold))
+            )
+
+    annualGWh = (meanFlow * inputs.ratios * heatFactor * gwhPerMWYear *
+                 loadFactor)
+
+    return (flow, heatMW, limitMW, annualGWh,
+            q95[inputs.gaugeIndex] * inputs.ratios,
+            q70[inputs.gaugeIndex] * inputs.ratios)
+
+
+def calcScenarios(inputs, scenarios):
+    """Calculates annual heat production of every river edge for each
+       scenario. scenarios is list in format of [(name, parameters)], where
+       parameters is a dictionary of calcHeat keyword arguments. Mean gauged
+       flows are only calculated once for each period. Yields tuples of
+       (name, annualGWh)."""
+
+    gaugeFlows = {}
+    for name, parameters in scenarios:
+        period = (parameters.get("start", defaultStart),
+                  parameters.get("end", defaultEnd))
+        if period not in gaugeFlows:
+            gaugeFlows[period] = calcGaugeMonthlyFlows(inputs, *period)
+
+        parameters = dict(parameters, gaugeFlows=gaugeFlows[period])
+        yield name, calcHeat(inputs, **parameters)[3]
+
+
+def getWalesEdgeIds(cur):
+    """Returns set of ids of river edges intersecting Wales."""
+
+    cur.execute("""SELECT r.id
+                   FROM riverEdges r, wales w
+                   WHERE ST_INTERSECTS(r.geometry, w.geometry)
+                   AND r.ROWID IN
+                       (SELECT ROWID
+                       FROM SpatialIndex
+                       WHERE f_table_name = 'riverEdges'
+                       AND search_frame = w.geometry);""")
+
+    return set(row[0] for row in cur)
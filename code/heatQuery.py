@@ -0,0 +1,376 @@
+import csv
+import math
+import argparse
+
+import numpy
+import shapely.wkb
+
+import profiling
+
+# Heat tables that can be queried, with their feature id column
+heatTables = [("annualHeat", "riverId"),
+              ("annualHeatLakes", "identifier")]
+
+
+def geometryParts(geometry):
+    """Returns list of arrays of the coordinates of each line string or
+       polygon ring of geometry."""
+
+    if hasattr(geometry, "geoms"):
+        return [c for g in geometry.geoms for c in geometryParts(g)]
+    if geometry.geom_type == "Polygon":
+        return ([numpy.asarray(geometry.exterior.coords)] +
+                [numpy.asarray(r.coords) for r in geometry.interiors])
+
+    return [numpy.asarray(geometry.coords)]
+
+
+def expandRanges(starts, counts):
+    """Returns array of the indices in each range, one range after the
+       other, and array of the range each index came from."""
+
+    ranges = numpy.repeat(numpy.arange(len(counts)), counts)
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(
+        numpy.cumsum(counts) - counts, counts
+    )
+
+    return numpy.repeat(starts, counts) + offsets, ranges
+
+
+class CellTable(object):
+    """Items in each cell of a grid, held in arrays sorted by cell key."""
+
+    def __init__(self, cellX, cellY, items):
+        self.minX = cellX.min() if len(cellX) else 0
+        self.minY = cellY.min() if len(cellY) else 0
+        self.rows = (cellY.max() - self.minY + 1) if len(cellY) else 1
+        self.columns = (cellX.max() - self.minX + 1) if len(cellX) else 0
+
+        keys = self.key(cellX, cellY)
+        order = numpy.argsort(keys, kind="mergesort")
+        self.items = items[order]
+        self.keys, starts = numpy.unique(keys[order], return_index=True)
+        self.starts = numpy.r_[starts, len(keys)].astype(numpy.int64)
+
+    def key(self, cellX, cellY):
+        return (cellX - self.minX) * self.rows + (cellY - self.minY)
+
+    def lookup(self, cellX, cellY):
+        """Returns arrays of the items in each cell and the index of the
+           cell each item was found in."""
+
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        if len(self.keys) == 0:
+            return empty, empty
+
+        keys = self.key(cellX, cellY)
+        positions = numpy.minimum(numpy.searchsorted(self.keys, keys),
+                                  len(self.keys) - 1)
+        found = numpy.nonzero(
+            (cellX >= self.minX) & (cellX < self.minX + self.columns) &
+            (cellY >= self.minY) & (cellY < self.minY + self.rows) &
+            (self.keys[positions] == keys)
+        )[0]
+        positions = positions[found]
+        indices, ranges = expandRanges(
+            self.starts[positions],
+            self.starts[positions + 1] - self.starts[positions]
+        )
+
+        return self.items[indices], found[ranges]
+
+
+def boxCells(minX, minY, maxX, maxY, cellSize):
+    """Finds every cell of size cellSize overlapped by each bounding box.
+       Returns arrays of cell column, cell row and box index."""
+
+    minCX = numpy.floor(minX / cellSize).astype(numpy.int64)
+    minCY = numpy.floor(minY / cellSize).astype(numpy.int64)
+    widths = numpy.floor(maxX / cellSize).astype(numpy.int64) - minCX + 1
+    counts = widths * (numpy.floor(maxY / cellSize).astype(numpy.int64) -
+                       minCY + 1)
+    offsets, boxes = expandRanges(
+        numpy.zeros(len(counts), dtype=numpy.int64), counts
+    )
+
+    return (minCX[boxes] + offsets % widths[boxes],
+            minCY[boxes] + offsets // widths[boxes], boxes)
+
+
+def bucketBoxes(minX, minY, maxX, maxY, cellSize, items=None):
+    """Returns CellTable of items in every cell of size cellSize overlapped
+       by their bounding boxes. Items default to the index of each box."""
+
+    if items is None:
+        items = numpy.arange(len(minX))
+    cellX, cellY, boxes = boxCells(minX, minY, maxX, maxY, cellSize)
+
+    return CellTable(cellX, cellY, items[boxes])
+
+
+class HeatIndex(object):
+    """Line segments of heat features bucketed in a grid of square cells,
+       for batched distance queries over arrays of points. Points inside
+       polygons are at distance 0 from them.
+
+       features is list in format of [(table, id, GWhPerYear, geometry)],
+       with Shapely geometries."""
+
+    def __init__(self, features, cellSize=500.0):
+        self.cellSize = float(cellSize)
+
+        self.tables = [f[0] for f in features]
+        self.ids = [f[1] for f in features]
+        self.gwh = numpy.array([f[2] for f in features], dtype=numpy.float64)
+
+        # Segments of all features, in feature order
+        x1, y1, x2, y2, featureOf = [], [], [], [], []
+        for i, feature in enumerate(features):
+            for coords in geometryParts(feature[3]):
+                if len(coords) < 2:
+                    continue
+                x1.append(coords[:-1, 0])
+                y1.append(coords[:-1, 1])
+                x2.append(coords[1:, 0])
+                y2.append(coords[1:, 1])
+                featureOf.append(numpy.full(len(coords) - 1, i,
+                                            dtype=numpy.int64))
+        empty = numpy.zeros(0)
+        self.x1 = numpy.concatenate(x1) if x1 else empty
+        self.y1 = numpy.concatenate(y1) if y1 else empty
+        self.x2 = numpy.concatenate(x2) if x2 else empty
+        self.y2 = numpy.concatenate(y2) if y2 else empty
+        self.featureOf = (numpy.concatenate(featureOf) if featureOf
+                          else numpy.zeros(0, dtype=numpy.int64))
+        self.featureStart = numpy.searchsorted(
+            self.featureOf, numpy.arange(len(features) + 1)
+        )
+
+        # Bucket segments in every cell their bounding box overlaps
+        self.segmentCells = bucketBoxes(
+            numpy.minimum(self.x1, self.x2), numpy.minimum(self.y1, self.y2),
+            numpy.maximum(self.x1, self.x2), numpy.maximum(self.y1, self.y2),
+            self.cellSize
+        )
+
+        # Bucket polygons in every cell their bounding box overlaps
+        polygons = [i for i, f in enumerate(features)
+                    if f[3].geom_type in ("Polygon", "MultiPolygon")]
+        bounds = numpy.array([features[i][3].bounds for i in polygons],
+                             dtype=numpy.float64).reshape(-1, 4)
+        self.polygonCells = bucketBoxes(
+            bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3],
+            self.cellSize, numpy.array(polygons, dtype=numpy.int64)
+        )
+
+    @classmethod
+    def fromDatabase(cls, cur, cellSize=500.0, tables=None):
+        """Reads features of annualHeat and annualHeatLakes tables, or only
+           those in list tables."""
+
+        features = []
+        for table, idColumn in heatTables:
+            if tables is not None and table not in tables:
+                continue
+            cur.execute("""SELECT %s, GWhPerYear, ST_AsBinary(geometry)
+                           FROM %s
+                           WHERE GWhPerYear IS NOT NULL
+                           AND geometry IS NOT NULL;""" % (idColumn, table))
+            features.extend((table, row[0], row[1],
+                             shapely.wkb.loads(str(row[2])))
+                            for row in cur)
+
+        return cls(features, cellSize)
+
+    def cellOf(self, x, y):
+        """Returns arrays of the column and row of the cells containing
+           points."""
+
+        return (numpy.floor(x / self.cellSize).astype(numpy.int64),
+                numpy.floor(y / self.cellSize).astype(numpy.int64))
+
+    def inside(self, points, features, x, y):
+        """Returns boolean array, True where point is inside polygon
+           feature, by counting crossings of its rings to the east of the
+           point."""
+
+        starts = self.featureStart[features]
+        segments, pairs = expandRanges(
+            starts, self.featureStart[features + 1] - starts
+        )
+        px = x[points[pairs]]
+        py = y[points[pairs]]
+        x1 = self.x1[segments]
+        y1 = self.y1[segments]
+        y2 = self.y2[segments]
+        spans = (y1 > py) != (y2 > py)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            crossX = x1 + (py - y1) * (self.x2[segments] - x1) / (y2 - y1)
+        crossings = numpy.bincount(pairs[spans & (px < crossX)],
+                                   minlength=len(points))
+
+        return crossings % 2 == 1
+
+    def pairs(self, x, y, radius):
+        """Returns arrays of point indices, feature indices and distances of
+           every feature within radius of each point, ordered by point and
+           then distance."""
+
+        # Segments in the cells around each point
+        reach = int(math.ceil(radius / self.cellSize))
+        offsetX, offsetY = [o.ravel() for o in numpy.meshgrid(
+            numpy.arange(-reach, reach + 1), numpy.arange(-reach, reach + 1)
+        )]
+        cellX, cellY = self.cellOf(x, y)
+        segments, cells = self.segmentCells.lookup(
+            (cellX[:, numpy.newaxis] + offsetX).ravel(),
+            (cellY[:, numpy.newaxis] + offsetY).ravel()
+        )
+        points = cells // len(offsetX)
+
+        # Distance from each point to the nearest point on each segment
+        px = x[points]
+        py = y[points]
+        x1 = self.x1[segments]
+        y1 = self.y1[segments]
+        dx = self.x2[segments] - x1
+        dy = self.y2[segments] - y1
+        length2 = dx * dx + dy * dy
+        length2[length2 == 0] = numpy.inf
+        t = numpy.clip(((px - x1) * dx + (py - y1) * dy) / length2, 0.0, 1.0)
+        distance2 = (px - x1 - t * dx) ** 2 + (py - y1 - t * dy) ** 2
+        near = numpy.nonzero(distance2 <= radius * radius)[0]
+        points = points[near]
+        features = self.featureOf[segments[near]]
+        distances = numpy.sqrt(distance2[near])
+
+        # Points inside polygons overlapping their own cell
+        polygons, polygonPoints = self.polygonCells.lookup(cellX, cellY)
+        inside = self.inside(polygonPoints, polygons, x, y)
+        points = numpy.r_[points, polygonPoints[inside]]
+        features = numpy.r_[features, polygons[inside]]
+        distances = numpy.r_[distances, numpy.zeros(inside.sum())]
+        if len(points) == 0:
+            return points, features, distances
+
+        # Nearest segment of each feature to each point
+        order = numpy.lexsort((distances, features, points))
+        points = points[order]
+        features = features[order]
+        first = numpy.r_[True, (points[1:] != points[:-1]) |
+                         (features[1:] != features[:-1])]
+        points = points[first]
+        features = features[first]
+        distances = distances[order][first]
+
+        order = numpy.lexsort((distances, points))
+
+        return points[order], features[order], distances[order]
+
+    def batches(self, x, y, radius, batchSize):
+        """Yields results of pairs for batches of points, with point indices
+           offset to index the whole of x and y."""
+
+        x = numpy.asarray(x, dtype=numpy.float64)
+        y = numpy.asarray(y, dtype=numpy.float64)
+        for start in range(0, len(x), batchSize):
+            end = start + batchSize
+            points, features, distances = self.pairs(x[start:end],
+                                                     y[start:end], radius)
+            yield points + start, features, distances
+
+    def nearest(self, x, y, radius, k=1, batchSize=10000):
+        """Finds the k nearest features within radius of each point. Returns
+           arrays of feature indices and distances with a row for each
+           point and a column for each of the k nearest, nearest first.
+           Indices are -1 and distances infinite where there are fewer than
+           k features."""
+
+        features = numpy.full((len(x), k), -1, dtype=numpy.int64)
+        distances = numpy.full((len(x), k), numpy.inf)
+        for p, f, d in self.batches(x, y, radius, batchSize):
+            starts = numpy.nonzero(numpy.r_[True, p[1:] != p[:-1]])[0]
+            ranks = numpy.arange(len(p)) - numpy.repeat(
+                starts, numpy.diff(numpy.r_[starts, len(p)])
+            )
+            keep = ranks < k
+            features[p[keep], ranks[keep]] = f[keep]
+            distances[p[keep], ranks[keep]] = d[keep]
+
+        return features, distances
+
+    def within(self, x, y, radius, batchSize=10000):
+        """Finds all features within radius of each point. Returns arrays of
+           point indices, feature indices and distances, ordered by point
+           and then distance."""
+
+        results = list(self.batches(x, y, radius, batchSize))
+        if not results:
+            return (numpy.zeros(0, dtype=numpy.int64),
+                    numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0))
+
+        return tuple(numpy.concatenate(r) for r in zip(*results))
+
+
+def readSites(sitesCsv):
+    """Reads csv file of sites with columns id, x and y. Returns list of
+       ids and arrays of x and y."""
+
+    with open(sitesCsv, "rb") as f:
+        sites = [(row["id"], float(row["x"]), float(row["y"]))
+                 for row in csv.DictReader(f)]
+
+    return ([s[0] for s in sites],
+            numpy.array([s[1] for s in sites], dtype=numpy.float64),
+            numpy.array([s[2] for s in sites], dtype=numpy.float64))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Finds the nearest rivers and lakes with heat "
+                    "production to each site in a csv file with columns "
+                    "id, x and y (British National Grid)."
+    )
+    parser.add_argument("sitesCsv", help="csv file of sites")
+    parser.add_argument("outputCsv", help="csv file of results")
+    parser.add_argument("--radius", type=float, default=500.0,
+                        help="search radius, units: meters, default: 500")
+    parser.add_argument("-k", type=int, default=1,
+                        help="number of features per site, default: 1")
+    parser.add_argument("--cell-size", type=float,
+                        help="index cell size, units: meters, default: "
+                             "the search radius")
+    args = parser.parse_args()
+
+    # Database path
+    sqliteDb = "../results/results.sqlite"
+
+    # Read heat features
+    profiling.stage("readHeatFeatures")
+    db = profiling.connect(sqliteDb)
+    try:
+        db.enable_load_extension(True)
+        db.load_extension("mod_spatialite")
+        index = HeatIndex.fromDatabase(db.cursor(),
+                                       args.cell_size or args.radius)
+    finally:
+        db.close()
+
+    # Find nearest features to sites
+    profiling.stage("nearest")
+    ids, x, y = readSites(args.sitesCsv)
+    features, distances = index.nearest(x, y, args.radius, args.k)
+
+    with open(args.outputCsv, "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(["siteId", "rank", "table", "featureId",
+                         "GWhPerYear", "distance"])
+        for i, siteId in enumerate(ids):
+            for rank in range(args.k):
+                feature = features[i, rank]
+                if feature < 0:
+                    break
+                writer.writerow([siteId, rank + 1, index.tables[feature],
+                                 index.ids[feature], index.gwh[feature],
+                                 "%.1f" % distances[i, rank]])
@@ -0,0 +1,99 @@
+import numpy
+
+# Letters of the OSGB grid, laid out in rows of five from the north west
+# corner. I is not used.
+letters = "ABCDEFGHJKLMNOPQRSTUVWXYZ"
+
+# Extent of 100 km grid squares covering Great Britain
+gbColumns = 7
+gbRows = 13
+
+
+def gridSquareCode(easting, northing):
+    """Returns two letter code of the 100 km grid square containing
+       easting and northing."""
+
+    if not (-1000000 <= easting < 1500000 and -500000 <= northing < 2000000):
+        raise ValueError("Coordinates outside the OSGB grid")
+    e500, e100 = divmod(int(easting) // 100000, 5)
+    n500, n100 = divmod(int(northing) // 100000, 5)
+
+    return (letters[(3 - n500) * 5 + e500 + 2] +
+            letters[(4 - n100) * 5 + e100])
+
+
+def gridSquareOrigin(code):
+    """Returns easting and northing of the south west corner of the 100 km
+       grid square with two letter code, e.g. "SV" is (0, 0)."""
+
+    first = letters.index(code[0].upper())
+    second = letters.index(code[1].upper())
+
+    return ((first % 5 - 2) * 500000 + second % 5 * 100000,
+            (3 - first // 5) * 500000 + (4 - second // 5) * 100000)
+
+
+def gridSquares():
+    """Returns dictionary of 100 km grid squares covering Great Britain, in
+       format of {gridSquareCode: (minX, minY)}. Equivalent to reading the
+       OS 100km_grid_region shapefile with readFlowData.getGridSquareMinXY."""
+
+    return dict((gridSquareCode(col * 100000, row * 100000),
+                 (col * 100000, row * 100000))
+                for col in range(gbColumns) for row in range(gbRows))
+
+
+def gridRefsToCoords(gridRefs, squares=None):
+    """Converts grid references such as "SO123456", of any precision, to
+       coordinates. Spaces are ignored. squares is an optional dictionary
+       in format of {gridSquareCode: (minX, minY)}; by default the square
+       origins are calculated from the letters. Returns arrays of easting,
+       northing and precision of each grid reference, units: meters."""
+
+    gridRefs = [g.replace(" ", "").upper() for g in gridRefs]
+    lengths = numpy.array([len(g) - 2 for g in gridRefs], dtype=numpy.int64)
+    if ((lengths < 0) | (lengths % 2 != 0) | (lengths > 10)).any():
+        raise ValueError("Grid references must be two letters followed by "
+                         "an even number of up to 10 digits")
+
+    # Table of grid square origins indexed by the codes of the two letters
+    if squares is None:
+        squares = dict((first + second, gridSquareOrigin(first + second))
+                       for first in letters for second in letters)
+    known = numpy.zeros((128, 128), dtype=bool)
+    originX = numpy.zeros((128, 128), dtype=numpy.int64)
+    originY = numpy.zeros((128, 128), dtype=numpy.int64)
+    for code, (minX, minY) in squares.iteritems():
+        known[ord(code[0]), ord(code[1])] = True
+        originX[ord(code[0]), ord(code[1])] = minX
+        originY[ord(code[0]), ord(code[1])] = minY
+
+    codes = numpy.frombuffer(
+        "".join(g[:2] for g in gridRefs).encode("ascii"), dtype=numpy.uint8
+    ).reshape(-1, 2)
+    if not known[codes[:, 0], codes[:, 1]].all():
+        raise ValueError("Unknown grid square in grid references")
+    eastings = originX[codes[:, 0], codes[:, 1]]
+    northings = originY[codes[:, 0], codes[:, 1]]
+    precisions = numpy.zeros(len(gridRefs), dtype=numpy.int64)
+
+    # Convert digits of grid references of each length at once
+    for length in numpy.unique(lengths).tolist():
+        rows = numpy.nonzero(lengths == length)[0]
+        precision = 10 ** (5 - length // 2)
+        precisions[rows] = precision
+        if length == 0:
+            continue
+
+        digits = numpy.frombuffer(
+            "".join(gridRefs[i][2:] for i in rows.tolist()).encode("ascii"),
+            dtype=numpy.uint8
+        ).reshape(len(rows), length).astype(numpy.int64) - ord("0")
+        if ((digits < 0) | (digits > 9)).any():
+            raise ValueError("Grid references must only contain digits "
+                             "after the grid square letters")
+        powers = 10 ** numpy.arange(length // 2 - 1, -1, -1)
+        eastings[rows] += digits[:, :length // 2].dot(powers) * precision
+        northings[rows] += digits[:, length // 2:].dot(powers) * precision
+
+    return eastings, northings, precisions
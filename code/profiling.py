@@ -0,0 +1,301 @@
+import os
+import sys
+import json
+import time
+import atexit
+import itertools
+import sqlite3
+import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
+
+# Directory profiles are written to. Profiling is off unless set.
+profileDir = os.environ.get("HEATMAP_PROFILE")
+
+# Statements with a query plan
+plannedStatements = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE",
+                     "WITH")
+
+
+def maxRss():
+    """Returns peak resident set size of this process, units: KiB on Linux,
+       or None if unknown."""
+
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Profiler(object):
+    """Records timings of stages of a script and of the SQL statements run
+       in each stage."""
+
+    def __init__(self, script):
+        self.script = script
+        self.started = datetime.datetime.now()
+        self.stages = []
+        self.statements = {}
+        self.explained = set()
+        self.stage("start")
+
+    def stage(self, name):
+        """Ends the current stage and starts a new one."""
+
+        self.endStage()
+        self.current = {"name": name,
+                        "clock": time.time(),
+                        "cpu": sum(os.times()[:2]),
+                        "excludedSeconds": 0.0,
+                        "excludedCpuSeconds": 0.0}
+
+    def endStage(self):
+        """Records wall clock and CPU time and peak memory of the current
+           stage."""
+
+        if getattr(self, "current", None) is None:
+            return
+        self.stages.append({
+            "name": self.current["name"],
+            "seconds": (time.time() - self.current["clock"] -
+                        self.current["excludedSeconds"]),
+            "cpuSeconds": (sum(os.times()[:2]) - self.current["cpu"] -
+                           self.current["excludedCpuSeconds"]),
+            "maxRssKiB": maxRss()
+        })
+        self.current = None
+
+    def exclude(self, seconds, cpuSeconds):
+        """Leaves time spent profiling out of the current stage."""
+
+        if getattr(self, "current", None) is not None:
+            self.current["excludedSeconds"] += seconds
+            self.current["excludedCpuSeconds"] += cpuSeconds
+
+    def statement(self, sql):
+        """Returns record of statement in the current stage."""
+
+        stage = self.current["name"] if self.current is not None else None
+        key = (stage, " ".join(sql.split()))
+        if key not in self.statements:
+            self.statements[key] = {"stage": stage, "sql": key[1],
+                                    "calls": 0, "seconds": 0.0,
+                                    "maxSeconds": 0.0, "fetchSeconds": 0.0,
+                                    "rows": 0, "fetched": 0, "plan": None}
+
+        return self.statements[key]
+
+    def profile(self):
+        """Returns profile as a dictionary."""
+
+        self.endStage()
+        stages = [s for s in self.stages
+                  if s["name"] != "start" or s["seconds"] > 0.001]
+
+        return {
+            "script": self.script,
+            "started": self.started.isoformat(),
+            "seconds": sum(s["seconds"] for s in stages),
+            "maxRssKiB": maxRss(),
+            "stages": stages,
+            "statements": sorted(
+                self.statements.values(),
+                key=lambda s: s["seconds"] + s["fetchSeconds"], reverse=True
+            )
+        }
+
+    def write(self, directory):
+        """Writes profile to directory as JSON, named after the script, and
+           prints a summary."""
+
+        profile = self.profile()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, self.script + ".json")
+        with open(path, "w") as f:
+            json.dump(profile, f, indent=2)
+
+        printSummary(profile, sys.stderr)
+        sys.stderr.write("Profile written to %s\n" % path)
+
+
+def printSummary(profile, f, statements=10):
+    """Prints table of stage times and the slowest statements."""
+
+    f.write("%-32s %10s %10s %12s\n"
+            % ("stage", "seconds", "cpu", "maxRssMiB"))
+    for s in profile["stages"]:
+        f.write("%-32s %10.2f %10.2f %12s\n" % (
+            s["name"][:32], s["seconds"], s["cpuSeconds"],
+            "%.1f" % (s["maxRssKiB"] / 1024.0)
+            if s["maxRssKiB"] is not None else "-"
+        ))
+
+    f.write("\n%-52s %6s %10s %10s\n"
+            % ("statement", "calls", "seconds", "rows"))
+    for s in profile["statements"][:statements]:
+        f.write("%-52s %6d %10.2f %10d\n" % (
+            s["sql"][:52], s["calls"], s["seconds"] + s["fetchSeconds"],
+            s["rows"] + s["fetched"]
+        ))
+
+
+def explain(cursor, sql, parameters):
+    """Returns query plan of statement as list of strings, or None."""
+
+    if (parameters is None or
+            not sql.lstrip().upper().startswith(plannedStatements)):
+        return None
+    try:
+        plan = cursor.execute("EXPLAIN QUERY PLAN " + sql,
+                              parameters).fetchall()
+    except sqlite3.Error:
+        return None
+
+    return [" ".join(str(column) for column in row) for row in plan]
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor recording the time, rows affected and query plan of every
+       statement, and the time spent fetching its results."""
+
+    record = None
+
+    def timed(self, sql, parameters, method, *args):
+        self.record = profiler.statement(sql)
+        if id(self.record) not in profiler.explained:
+            profiler.explained.add(id(self.record))
+            self.connection.unexplained.append((self.record, sql,
+                                                parameters))
+
+        started = time.time()
+        result = method(self, sql, *args)
+        seconds = time.time() - started
+
+        self.record["calls"] += 1
+        self.record["seconds"] += seconds
+        self.record["maxSeconds"] = max(self.record["maxSeconds"], seconds)
+        if self.rowcount > 0:
+            self.record["rows"] += self.rowcount
+
+        return result
+
+    def execute(self, sql, parameters=()):
+        return self.timed(sql, parameters, sqlite3.Cursor.execute,
+                          parameters)
+
+    def executemany(self, sql, seqOfParameters):
+        seqOfParameters = iter(seqOfParameters)
+        first = next(seqOfParameters, None)
+        if first is None:
+            return self.timed(sql, (), sqlite3.Cursor.executemany, [])
+
+        return self.timed(sql, first, sqlite3.Cursor.executemany,
+                          itertools.chain([first], seqOfParameters))
+
+    def executescript(self, sql):
+        return self.timed(sql, None, sqlite3.Cursor.executescript)
+
+    def fetched(self, method, *args):
+        started = time.time()
+        rows = method(self, *args)
+        if self.record is not None:
+            self.record["fetchSeconds"] += time.time() - started
+            if isinstance(rows, list):
+                self.record["fetched"] += len(rows)
+            elif rows is not None:
+                self.record["fetched"] += 1
+
+        return rows
+
+    def next(self):
+        return self.fetched(sqlite3.Cursor.next)
+
+    def fetchone(self):
+        return self.fetched(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self.fetched(sqlite3.Cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self.fetched(sqlite3.Cursor.fetchall)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection whose cursors are ProfiledCursors. Query plans are only
+       recorded while no transaction is open, after commit or rollback or
+       on close, as sqlite3 commits any open transaction before running
+       EXPLAIN."""
+
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.unexplained = []  # (record, sql, parameters) without a plan
+        self.committedChanges = 0
+
+    def explainStatements(self):
+        """Records query plans of statements run since the last commit,
+           unless rows changed since then, i.e. a transaction is open."""
+
+        if not self.unexplained or self.total_changes != self.committedChanges:
+            return
+        started = time.time()
+        cpu = sum(os.times()[:2])
+        cursor = sqlite3.Connection.cursor(self)
+        for record, sql, parameters in self.unexplained:
+            record["plan"] = explain(cursor, sql, parameters)
+        self.unexplained = []
+        profiler.exclude(time.time() - started, sum(os.times()[:2]) - cpu)
+
+    def commit(self):
+        sqlite3.Connection.commit(self)
+        self.committedChanges = self.total_changes
+        self.explainStatements()
+
+    def rollback(self):
+        sqlite3.Connection.rollback(self)
+        self.committedChanges = self.total_changes
+        self.explainStatements()
+
+    def close(self):
+        self.explainStatements()
+        sqlite3.Connection.close(self)
+
+    def cursor(self, factory=ProfiledCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seqOfParameters):
+        return self.cursor().executemany(sql, seqOfParameters)
+
+
+def connect(database):
+    """Opens sqlite database. Statements are profiled if the
+       HEATMAP_PROFILE environment variable is set."""
+
+    if profiler is None:
+        return sqlite3.connect(database)
+
+    return sqlite3.connect(database, factory=ProfiledConnection)
+
+
+def stage(name):
+    """Marks the start of a stage of the script, ending the previous stage.
+       Does nothing unless profiling."""
+
+    if profiler is not None:
+        profiler.stage(name)
+
+
+# Profile the running script if enabled, writing the profile on exit
+if profileDir:
+    profiler = Profiler(
+        os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0]
+    )
+    atexit.register(profiler.write, profileDir)
+else:
+    profiler = None
@@ -2,9 +2,22 @@ import csv
 import collections
 import os
 import glob
-import sqlite3
+import datetime
+import itertools
+import multiprocessing
+import argparse
 
-import ogr
+try:
+    import ogr
+except ImportError:
+    ogr = None  # Only needed to read grid squares from a shapefile
+
+import flowStore
+import osgbGrid
+import profiling
+
+# First fields of metadata rows in Gauged Monthly Flows csv files
+metadataKeys = ("file", "database", "station", "dataType", "data")
 
 
 def getGridSquareMinXY(gridSquaresShp):
@@ -40,18 +53,64 @@ def getRiverIDs(lookupCsv):
     return d
 
 
-def readGmfCsv(gmfCsv):
-    """ Read in Gauged Monthly Flows csv file. Returns dictionaries of
-        data and metadata."""
+def parseDate(value):
+    """Parses date in format of "YYYY-MM-DD", or "YYYY-MM" for the first day
+       of the month. Returns datetime.date."""
+
+    parts = value.split("-")
+
+    return datetime.date(int(parts[0]), int(parts[1]),
+                         int(parts[2]) if len(parts) > 2 else 1)
+
+
+def parseFlow(value):
+    """Parses flow as float, or None if missing."""
+
+    return float(value) if value.strip() else None
+
+
+def streamGmfCsv(gmfCsv, chunkSize=10000):
+    """Reads Gauged Monthly Flows csv file one row at a time. Yields
+       dictionary of metadata first, then lists of up to chunkSize flows in
+       format of [(date, flow)], with dates as datetime.date and flows as
+       floats or None where missing."""
 
-    d = collections.defaultdict(dict)
     with open(gmfCsv, "rb") as f:
         reader = csv.reader(f)
+
+        # Metadata rows come before the flows
+        metadata = collections.defaultdict(dict)
+        firstRows = []
         for row in reader:
-            if row[0] in ("file", "database", "station", "dataType", "data"):
-                d[row[0]].update({row[1]: row[2]})
-            else:
-                d["gmf"].update({row[0]: row[1]})
+            if not row:
+                continue
+            if row[0] not in metadataKeys:
+                firstRows.append(row)
+                break
+            metadata[row[0]][row[1]] = row[2]
+        yield metadata
+
+        chunk = []
+        for row in itertools.chain(firstRows, reader):
+            if not row:
+                continue
+            if row[0] in metadataKeys:
+                raise ValueError("Metadata row after flows in %s" % gmfCsv)
+            chunk.append((parseDate(row[0]), parseFlow(row[1])))
+            if len(chunk) == chunkSize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def readGmfCsv(gmfCsv):
+    """ Read in Gauged Monthly Flows csv file. Returns dictionaries of
+        data and metadata."""
+
+    stream = streamGmfCsv(gmfCsv)
+    d = next(stream)
+    d["gmf"] = dict(flow for chunk in stream for flow in chunk)
 
     return d
 
@@ -61,18 +120,13 @@ def calcStationCoords(station, gridSquares):
         station grid reference. Returns dictionary with the additional
         keys."""
 
-    # calculate coordinates and precision
-    gridRef = station["gridReference"]
-    gridCode = gridRef[:2]
-    station["precision"] = 10 ** (5 - len(gridRef[2:])/2)  # Units: meters
-    station["easting"] = (
-        gridSquares[gridCode][0] + int(gridRef[2:len(gridRef[2:])/2 + 2]) *
-        station["precision"]
-    )
-    station["northing"] = (
-        gridSquares[gridCode][1] + int(gridRef[len(gridRef[2:])/2 + 2:]) *
-        station["precision"]
+    # calculate coordinates and precision, units: meters
+    eastings, northings, precisions = osgbGrid.gridRefsToCoords(
+        [station["gridReference"]], gridSquares
     )
+    station["precision"] = int(precisions[0])
+    station["easting"] = int(eastings[0])
+    station["northing"] = int(northings[0])
 
     return station
 
@@ -87,24 +141,137 @@ def addStationRiverID(station, riverIDs):
     return station
 
 
+def metadataRows(data, gridSquares, riverIDs):
+    """Calculates station coordinates and adds river ID to the metadata of
+       a Gauged Monthly Flows csv file. Returns tuple of nrfaStations,
+       nrfaDataTypes and nrfaData rows."""
+
+    # Calculate station coordinates
+    data["station"] = calcStationCoords(data["station"], gridSquares)
+
+    # Add river ID to station
+    data["station"] = addStationRiverID(data["station"], riverIDs)
+
+    return (
+        (data["station"].get("id"),
+         data["station"].get("name"),
+         data["station"].get("stationComment"),
+         data["station"].get("catchmentComment"),
+         data["station"].get("precision"),
+         data["station"].get("riverId"),
+         data["station"].get("easting"),
+         data["station"].get("northing")),
+        (data["dataType"].get("id"),
+         data["dataType"].get("name"),
+         data["dataType"].get("parameter"),
+         data["dataType"].get("units"),
+         data["dataType"].get("period"),
+         data["dataType"].get("measurementType")),
+        (data["station"].get("id"),
+         data["dataType"].get("id"),
+         data["data"].get("first"),
+         data["data"].get("last"))
+    )
+
+
+def readStationRows(gmfCsv, gridSquares, riverIDs):
+    """Reads Gauged Monthly Flows csv file, calculating station coordinates
+       and adding river ID. Returns tuple of nrfaStations, nrfaDataTypes and
+       nrfaData rows, and list of nrfaGmf rows."""
+
+    stream = streamGmfCsv(gmfCsv)
+    stationRow, dataTypeRow, dataRow = metadataRows(next(stream),
+                                                    gridSquares, riverIDs)
+
+    return (
+        stationRow,
+        dataTypeRow,
+        dataRow,
+        [(stationRow[0], dataTypeRow[0], date, flow)
+         for chunk in stream for date, flow in chunk]
+    )
+
+
+def loadStation(cur, gmfCsv, gridSquares, riverIDs, chunkSize=10000):
+    """Reads Gauged Monthly Flows csv file and inserts its rows into tables,
+       streaming the flows in chunks of chunkSize rows."""
+
+    stream = streamGmfCsv(gmfCsv, chunkSize)
+    stationRow, dataTypeRow, dataRow = metadataRows(next(stream),
+                                                    gridSquares, riverIDs)
+    insertStationRows(cur, (stationRow, dataTypeRow, dataRow, []))
+    for chunk in stream:
+        cur.executemany(
+            "INSERT INTO nrfaGmf VALUES (?, ?, ?, ?);",
+            [(stationRow[0], dataTypeRow[0], date, flow)
+             for date, flow in chunk]
+        )
+
+
+def initStationWorker(gridSquares, riverIDs):
+    """Stores grid squares and river IDs for readStationWorker."""
+
+    global workerGridSquares, workerRiverIDs
+    workerGridSquares = gridSquares
+    workerRiverIDs = riverIDs
+
+
+def readStationWorker(gmfCsv):
+    """Calls readStationRows in a worker process."""
+
+    return readStationRows(gmfCsv, workerGridSquares, workerRiverIDs)
+
+
+def insertStationRows(cur, rows):
+    """Inserts rows returned by readStationRows into tables."""
+
+    stationRow, dataTypeRow, dataRow, gmfRows = rows
+    cur.execute("""INSERT INTO nrfaStations
+                   VALUES (?, ?, ?, ?, ?, ?,
+                           MakePoint(?, ?, 27700));""",
+                stationRow)
+    cur.execute("""INSERT INTO nrfaDataTypes
+                   VALUES (?, ?, ?, ?, ?, ?);""",
+                dataTypeRow)
+    cur.execute("""INSERT INTO nrfaData VALUES (?, ?, ?, ?);""",
+                dataRow)
+    cur.executemany("INSERT INTO nrfaGmf VALUES (?, ?, ?, ?);", gmfRows)
+
+
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(
+        description="Loads NRFA Gauged Monthly Flow data into the results "
+                    "database."
+    )
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes reading csv files")
+    parser.add_argument("--flow-store", metavar="DIR",
+                        help="also save flows as a columnar store in DIR")
+    parser.add_argument("--grid-squares", metavar="SHP",
+                        help="read 100 km grid squares from shapefile, e.g. "
+                             "../data/gb-grids_654971/100km_grid_region.shp, "
+                             "instead of the built-in OSGB grid squares")
+    args = parser.parse_args()
+
     # Input paths
     csvDir = "../data/nrfa/NRFA Flow Data Retrieval"
-    gridSquaresShp = "../data/gb-grids_654971/100km_grid_region.shp"
     lookupCsv = "../data/riverStationLookup.csv"
 
     # Output paths
     outDb = "../results/results.sqlite"
 
     # Calculate grid square min x and y coordinates
-    gridSquares = getGridSquareMinXY(gridSquaresShp)
+    if args.grid_squares is not None:
+        gridSquares = getGridSquareMinXY(args.grid_squares)
+    else:
+        gridSquares = osgbGrid.gridSquares()
 
     # Get river IDs for each station from lookup table
     riverIDs = getRiverIDs(lookupCsv)
 
     # Connect to output database
-    db = sqlite3.connect(outDb)
+    db = profiling.connect(outDb)
     try:
         db.enable_load_extension(True)
         db.load_extension("mod_spatialite")
@@ -112,6 +279,7 @@ if __name__ == "__main__":
         cur.execute("SELECT InitSpatialMetaData(1);")
 
         # Create tables
+        profiling.stage("createTables")
         cur.execute("DROP TABLE IF EXISTS nrfaStations;")
         cur.execute("""CREATE TABLE nrfaStations (
                        id INTEGER PRIMARY KEY,
@@ -154,54 +322,31 @@ if __name__ == "__main__":
                        FOREIGN KEY(dataType) REFERENCES nrfaDataTypes(id));""")
 
         # Read data from csv files
-        for csvFile in glob.iglob(os.path.join(csvDir, "*.csv")):
-            data = readGmfCsv(csvFile)
-
-            # Calculate station coordinates
-            data["station"] = calcStationCoords(data["station"], gridSquares)
-
-            # Add river ID to station
-            data["station"] = addStationRiverID(data["station"], riverIDs)
-
-            # Insert data into tables
-            cur.execute("""INSERT INTO nrfaStations
-                           VALUES (?, ?, ?, ?, ?, ?,
-                                   MakePoint(?, ?, 27700));""",
-                        (data["station"].get("id"),
-                         data["station"].get("name"),
-                         data["station"].get("stationComment"),
-                         data["station"].get("catchmentComment"),
-                         data["station"].get("precision"),
-                         data["station"].get("riverId"),
-                         data["station"].get("easting"),
-                         data["station"].get("northing")))
-            cur.execute("""INSERT INTO nrfaDataTypes
-                           VALUES (?, ?, ?, ?, ?, ?);""",
-                        (data["dataType"].get("id"),
-                         data["dataType"].get("name"),
-                         data["dataType"].get("parameter"),
-                         data["dataType"].get("units"),
-                         data["dataType"].get("period"),
-                         data["dataType"].get("measurementType")))
-            cur.execute("""INSERT INTO nrfaData VALUES (?, ?, ?, ?);""",
-                        (data["station"].get("id"),
-                         data["dataType"].get("id"),
-                         data["data"].get("first"),
-                         data["data"].get("last")))
-            cur.executemany(
-                "INSERT INTO nrfaGmf VALUES (?, ?, ?, ?);",
-                [(
-                    data["station"].get("id"),
-                    data["dataType"].get("id"),
-                    k,
-                    v
-                ) for k, v in data["gmf"].iteritems()]
-            )
+        profiling.stage("readCsvFiles")
+        csvFiles = glob.glob(os.path.join(csvDir, "*.csv"))
+        if args.processes > 1:
+            pool = multiprocessing.Pool(args.processes, initStationWorker,
+                                        (gridSquares, riverIDs))
+            try:
+                for rows in pool.imap(readStationWorker, csvFiles,
+                                      chunksize=16):
+                    insertStationRows(cur, rows)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for csvFile in csvFiles:
+                loadStation(cur, csvFile, gridSquares, riverIDs)
 
         # Create spatial index
+        profiling.stage("createSpatialIndex")
         cur.execute("SELECT DisableSpatialIndex('nrfaStations', 'geometry');")
         cur.execute("SELECT CreateSpatialIndex('nrfaStations', 'geometry');")
 
+        # Save columnar copy of flows
+        if args.flow_store is not None:
+            flowStore.FlowStore.fromDatabase(cur).save(args.flow_store)
+
     finally:
         # Commit changes and close database
         db.commit()
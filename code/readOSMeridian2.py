@@ -1,8 +1,14 @@
-import sqlite3
 import os
+import Queue
+import itertools
+import multiprocessing
+import argparse
+import traceback
 
 import ogr
 
+import profiling
+
 # Inputs
 osMeridian2Dir = "../data/meridian2_national_841398"
 districtsShp = os.path.join(osMeridian2Dir, "district_region.shp")
@@ -37,132 +43,234 @@ districtNames = ['GWYNEDD - GWYNEDD',
                  'ABERTAWE - SWANSEA',
                  'CAERDYDD - CARDIFF']
 
-# Connect to database
-with sqlite3.connect(sqliteDb) as db:
-    db.enable_load_extension(True)
-    db.load_extension("mod_spatialite")
-    cur = db.cursor()
-    cur.execute("SELECT InitSpatialMetaData(1);")
-
-    # Create districts table
-    cur.execute("DROP TABLE IF EXISTS osDistricts;")
-    cur.execute("""CREATE TABLE osDistricts (
-                   id INTEGER PRIMARY KEY AUTOINCREMENT,
-                   name TEXT);""")
-    cur.execute("""SELECT AddGeometryColumn('osDistricts',
-                                            'geometry',
-                                            27700,
-                                            'POLYGON');""")
-
-    # Create rivers table
-    cur.execute("DROP TABLE IF EXISTS osRivers;")
-    cur.execute("""CREATE TABLE osRivers (
-                   id INTEGER PRIMARY KEY AUTOINCREMENT,
-                   identifier TEXT,
-                   code INTEGER,
-                   name TEXT);""")
-    cur.execute("""SELECT AddGeometryColumn('osRivers',
-                                            'geometry',
-                                            27700,
-                                            'LINESTRING');""")
-
-    # Create coastline table
-    cur.execute("DROP TABLE IF EXISTS osCoastline;")
-    cur.execute("""CREATE TABLE osCoastline (
-                   id INTEGER PRIMARY KEY AUTOINCREMENT);""")
-    cur.execute("""SELECT AddGeometryColumn('osCoastline',
-                                            'geometry',
-                                            27700,
-                                            'LINESTRING');""")
-
-    # Create lakes table
-    cur.execute("DROP TABLE IF EXISTS osLakes;")
-    cur.execute("""CREATE TABLE osLakes (
-                   id INTEGER PRIMARY KEY AUTOINCREMENT,
-                   identifier TEXT,
-                   code INTEGER,
-                   name TEXT);""")
-    cur.execute("""SELECT AddGeometryColumn('osLakes',
-                                            'geometry',
-                                            27700,
-                                            'POLYGON');""")
-
-    # Read districts from shape
-    dataSource = ogr.Open(districtsShp)
+
+def readFeatures(shp, fields, attributeFilter=None):
+    """Reads features from shapefile, optionally filtered by attribute.
+       Yields tuples of the field values followed by the geometry as
+       WKB."""
+
+    dataSource = ogr.Open(shp)
     layer = dataSource.GetLayer()
-    layer.SetAttributeFilter("NAME IN ('%s')" % "','".join(districtNames))
+    if attributeFilter is not None:
+        layer.SetAttributeFilter(attributeFilter)
 
     for feature in layer:
-        geometry = feature.GetGeometryRef().ExportToWkt()
-        name = feature.GetField("NAME")
+        values = [feature.GetField(field) for field in fields]
+        values.append(buffer(feature.GetGeometryRef().ExportToWkb()))
+        yield tuple(values)
 
-        # Insert data into osDistricts table
-        cur.execute("""INSERT INTO osDistricts (name, geometry)
-                       VALUES (?, ST_GeomFromText(?, 27700));""",
-                    (name, geometry))
 
-    # Read rivers from shape
-    dataSource = ogr.Open(riversShp)
-    layer = dataSource.GetLayer()
-    layer.SetAttributeFilter("CODE IN (6224, 6225, 6232)")
+def chunks(iterable, chunkSize):
+    """Yields lists of up to chunkSize items from iterable."""
 
-    for feature in layer:
-        geometry = feature.GetGeometryRef().ExportToWkt()
-        identifier = feature.GetField("IDENTIFIER")
-        code = feature.GetField("CODE")
-        name = feature.GetField("NAME")
-
-        # Insert data into osRivers table
-        cur.execute("""INSERT INTO osRivers (identifier, code, name, geometry)
-                       VALUES (?, ?, ?, ST_GeomFromText(?, 27700));""",
-                    (identifier, code, name, geometry))
-
-    # Read coastlines from shape
-    dataSource = ogr.Open(coastShp)
-    layer = dataSource.GetLayer()
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunkSize))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunkSize))
 
-    for feature in layer:
-        geometry = feature.GetGeometryRef().ExportToWkt()
 
-        # Insert data into osCoastline table
-        cur.execute("""INSERT INTO osCoastline (geometry)
-                       VALUES (ST_GeomFromText(?, 27700));""",
-                    (geometry,))
+def insertSql(table, columns):
+    """Returns statement inserting the column values and WKB geometry of a
+       feature into table."""
 
-    # Read lakes from shape
-    dataSource = ogr.Open(lakesShp)
-    layer = dataSource.GetLayer()
+    return """INSERT INTO %s (%s)
+              VALUES (%s);""" % (
+        table,
+        ", ".join(columns + ["geometry"]),
+        ", ".join(["?"] * len(columns) + ["ST_GeomFromWKB(?, 27700)"])
+    )
 
-    for feature in layer:
-        geometry = feature.GetGeometryRef().ExportToWkt()
-        identifier = feature.GetField("IDENTIFIER")
-        code = feature.GetField("CODE")
-        name = feature.GetField("NAME")
-
-        # Insert data into osLakes table
-        cur.execute("""INSERT INTO osLakes (identifier, code, name, geometry)
-                       VALUES (?, ?, ?, ST_GeomFromText(?, 27700));""",
-                    (identifier, code, name, geometry))
-
-    # Build spatial indexes
-    cur.execute("SELECT CreateSpatialIndex('osDistricts', 'geometry');")
-    cur.execute("SELECT CreateSpatialIndex('osRivers', 'geometry');")
-    cur.execute("SELECT CreateSpatialIndex('osCoastline', 'geometry');")
-    cur.execute("SELECT CreateSpatialIndex('osLakes', 'geometry');")
-
-    # Dissolve welsh districts to single polygon
-    cur.execute("DROP TABLE IF EXISTS wales;")
-    cur.execute("""CREATE TABLE wales (
-                   id INTEGER PRIMARY KEY AUTOINCREMENT,
-                   name TEXT);""")
-    cur.execute("""SELECT AddGeometryColumn('Wales',
-                                            'geometry',
-                                            27700,
-                                            'MULTIPOLYGON');""")
-    cur.execute("""INSERT INTO wales (name, geometry)
-                   SELECT 'Wales', ST_UNION(geometry)
-                   FROM osDistricts;""")
-    cur.execute("SELECT CreateSpatialIndex('wales', 'geometry');")
-
-    # Commit changes to database
-    db.commit()
+
+def loadFeatures(cur, table, columns, features, chunkSize=10000):
+    """Inserts features into table in batches. Features are tuples of the
+       column values followed by the geometry as WKB."""
+
+    sql = insertSql(table, columns)
+    for chunk in chunks(features, chunkSize):
+        cur.executemany(sql, chunk)
+
+
+def readLayerWorker(queue, table, shp, fields, attributeFilter, chunkSize):
+    """Reads shapefile in a worker process. Puts (table, features, error)
+       tuples on queue, with features in batches of up to chunkSize,
+       followed by (table, None, None) once the layer is finished or
+       (table, None, traceback) if reading fails."""
+
+    try:
+        features = readFeatures(shp, fields, attributeFilter)
+        for chunk in chunks(features, chunkSize):
+            # Buffers can't be pickled, send WKB as string
+            queue.put((table, [f[:-1] + (str(f[-1]),) for f in chunk], None))
+    except Exception:
+        queue.put((table, None, traceback.format_exc()))
+    else:
+        queue.put((table, None, None))
+
+
+def loadLayersParallel(cur, layers, chunkSize=10000, pollInterval=1.0):
+    """Reads each layer in its own process and inserts the batches as they
+       arrive, building each table's spatial index as soon as it is loaded.
+       layers is list in format of
+       [(table, columns, shp, fields, attributeFilter)]. Raises
+       RuntimeError if a worker fails or exits without finishing its layer,
+       checked every pollInterval seconds while waiting for batches."""
+
+    queue = multiprocessing.Queue(maxsize=4 * len(layers))
+    workers = {}
+    for table, columns, shp, fields, attributeFilter in layers:
+        worker = multiprocessing.Process(
+            target=readLayerWorker,
+            args=(queue, table, shp, fields, attributeFilter, chunkSize)
+        )
+        worker.start()
+        workers[table] = worker
+
+    sqls = dict((layer[0], insertSql(layer[0], layer[1])) for layer in layers)
+    unfinished = set(workers)
+    try:
+        while unfinished:
+            # Workers flush their batches before exiting, so a worker that
+            # had exited before an empty wait never finished its layer
+            exited = [t for t in unfinished
+                      if workers[t].exitcode is not None]
+            try:
+                table, features, error = queue.get(timeout=pollInterval)
+            except Queue.Empty:
+                if exited:
+                    raise RuntimeError(
+                        "Worker reading %s exited with code %d without "
+                        "finishing" % (exited[0], workers[exited[0]].exitcode)
+                    )
+                continue
+
+            if error is not None:
+                raise RuntimeError("Failed to read %s:\n%s" % (table, error))
+            elif features is None:
+                unfinished.remove(table)
+                cur.execute("SELECT CreateSpatialIndex(?, 'geometry');",
+                            (table,))
+            else:
+                cur.executemany(
+                    sqls[table], [f[:-1] + (buffer(f[-1]),) for f in features]
+                )
+    finally:
+        for table, worker in workers.iteritems():
+            if table in unfinished:
+                worker.terminate()
+            worker.join()
+
+
+def setBulkLoadPragmas(cur):
+    """Trades durability for speed while the database is being loaded."""
+
+    cur.execute("PRAGMA journal_mode = MEMORY;")
+    cur.execute("PRAGMA synchronous = OFF;")
+    cur.execute("PRAGMA cache_size = -262144;")  # Units: KiB
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Loads OS Meridian 2 data into the results database."
+    )
+    parser.add_argument("--parallel", action="store_true",
+                        help="read each shapefile in its own process")
+    args = parser.parse_args()
+
+    # Connect to database
+    with profiling.connect(sqliteDb) as db:
+        db.enable_load_extension(True)
+        db.load_extension("mod_spatialite")
+        cur = db.cursor()
+        setBulkLoadPragmas(cur)
+        cur.execute("SELECT InitSpatialMetaData(1);")
+
+        # Create districts table
+        profiling.stage("createTables")
+        cur.execute("DROP TABLE IF EXISTS osDistricts;")
+        cur.execute("""CREATE TABLE osDistricts (
+                       id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       name TEXT);""")
+        cur.execute("""SELECT AddGeometryColumn('osDistricts',
+                                                'geometry',
+                                                27700,
+                                                'POLYGON');""")
+
+        # Create rivers table
+        cur.execute("DROP TABLE IF EXISTS osRivers;")
+        cur.execute("""CREATE TABLE osRivers (
+                       id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       identifier TEXT,
+                       code INTEGER,
+                       name TEXT);""")
+        cur.execute("""SELECT AddGeometryColumn('osRivers',
+                                                'geometry',
+                                                27700,
+                                                'LINESTRING');""")
+
+        # Create coastline table
+        cur.execute("DROP TABLE IF EXISTS osCoastline;")
+        cur.execute("""CREATE TABLE osCoastline (
+                       id INTEGER PRIMARY KEY AUTOINCREMENT);""")
+        cur.execute("""SELECT AddGeometryColumn('osCoastline',
+                                                'geometry',
+                                                27700,
+                                                'LINESTRING');""")
+
+        # Create lakes table
+        cur.execute("DROP TABLE IF EXISTS osLakes;")
+        cur.execute("""CREATE TABLE osLakes (
+                       id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       identifier TEXT,
+                       code INTEGER,
+                       name TEXT);""")
+        cur.execute("""SELECT AddGeometryColumn('osLakes',
+                                                'geometry',
+                                                27700,
+                                                'POLYGON');""")
+
+        # Read layers from shapes
+        profiling.stage("readLayers")
+        districtsFilter = "NAME IN ('%s')" % "','".join(districtNames)
+        layers = [
+            ("osDistricts", ["name"],
+             districtsShp, ["NAME"], districtsFilter),
+            ("osRivers", ["identifier", "code", "name"],
+             riversShp, ["IDENTIFIER", "CODE", "NAME"],
+             "CODE IN (6224, 6225, 6232)"),
+            ("osCoastline", [],
+             coastShp, [], None),
+            ("osLakes", ["identifier", "code", "name"],
+             lakesShp, ["IDENTIFIER", "CODE", "NAME"], None)
+        ]
+
+        if args.parallel:
+            loadLayersParallel(cur, layers)
+        else:
+            for table, columns, shp, fields, attributeFilter in layers:
+                loadFeatures(cur, table, columns,
+                             readFeatures(shp, fields, attributeFilter))
+
+            # Build spatial indexes
+            for table, columns, shp, fields, attributeFilter in layers:
+                cur.execute("SELECT CreateSpatialIndex(?, 'geometry');",
+                            (table,))
+
+        # Dissolve welsh districts to single polygon
+        profiling.stage("dissolveWales")
+        cur.execute("DROP TABLE IF EXISTS wales;")
+        cur.execute("""CREATE TABLE wales (
+                       id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       name TEXT);""")
+        cur.execute("""SELECT AddGeometryColumn('Wales',
+                                                'geometry',
+                                                27700,
+                                                'MULTIPOLYGON');""")
+        cur.execute("""INSERT INTO wales (name, geometry)
+                       SELECT 'Wales', ST_UNION(geometry)
+                       FROM osDistricts;""")
+        cur.execute("SELECT CreateSpatialIndex('wales', 'geometry');")
+
+        # Commit changes to database
+        db.commit()
@@ -0,0 +1,156 @@
+import collections
+
+import numpy
+
+
+def compressedIndex(nodes, nodeCount):
+    """Groups edges by node. nodes is array of the node index of each edge.
+       Returns arrays of pointers and edge indices, where the edges of node
+       i are edges[pointers[i]:pointers[i + 1]]."""
+
+    edges = numpy.argsort(nodes, kind="mergesort").astype(numpy.int32)
+    pointers = numpy.zeros(nodeCount + 1, dtype=numpy.int64)
+    pointers[1:] = numpy.cumsum(numpy.bincount(nodes, minlength=nodeCount))
+
+    return pointers, edges
+
+
+class RiverGraph(object):
+    """Directed multigraph of river nodes and edges held in NumPy arrays.
+       Nodes and edges are referred to by index. Edges are indexed by start
+       and end node in compressed sparse row format. Edge attributes are
+       arrays: length, upstreamLength, nearestGaugedEdge (index of the
+       nearest gauged edge, -1 if none) and upstreamLengthRatio."""
+
+    def __init__(self, nodeIds, edgeIds, edgeStart, edgeEnd, edgeLength):
+        self.nodeIds = numpy.asarray(nodeIds, dtype=numpy.int64)
+        self.edgeIds = numpy.asarray(edgeIds)
+
+        # Node index of edge start and end
+        nodeOrder = numpy.argsort(self.nodeIds)
+        self.start = nodeOrder[numpy.searchsorted(
+            self.nodeIds, edgeStart, sorter=nodeOrder
+        )].astype(numpy.int32)
+        self.end = nodeOrder[numpy.searchsorted(
+            self.nodeIds, edgeEnd, sorter=nodeOrder
+        )].astype(numpy.int32)
+
+        self.outPointers, self.outEdges = compressedIndex(
+            self.start, len(self.nodeIds)
+        )
+        self.inPointers, self.inEdges = compressedIndex(
+            self.end, len(self.nodeIds)
+        )
+
+        # Edge attributes
+        self.length = numpy.asarray(edgeLength, dtype=numpy.float64)
+        self.upstreamLength = numpy.full(len(self.edgeIds), numpy.nan)
+        self.nearestGaugedEdge = numpy.full(len(self.edgeIds), -1,
+                                            dtype=numpy.int32)
+        self.upstreamLengthRatio = numpy.full(len(self.edgeIds), numpy.nan)
+
+    @classmethod
+    def fromSnapshot(cls, snapshot):
+        """Creates graph from graphSnapshot.GraphSnapshot."""
+
+        return cls(snapshot.nodeIds, snapshot.edgeIds, snapshot.edgeStart,
+                   snapshot.edgeEnd, snapshot.edgeLength)
+
+    @classmethod
+    def fromDatabase(cls, cur):
+        """Creates graph from riverNodes table and riverEdges with start and
+           end nodes."""
+
+        cur.execute("SELECT id FROM riverNodes ORDER BY id;")
+        nodeIds = [row[0] for row in cur]
+
+        cur.execute("""SELECT id, startNodeId, endNodeId, ST_Length(geometry)
+                       FROM riverEdges
+                       WHERE startNodeId IS NOT NULL
+                       AND endNodeId IS NOT NULL
+                       ORDER BY ROWID;""")
+        edges = cur.fetchall()
+
+        return cls(nodeIds,
+                   numpy.array([e[0] for e in edges], dtype=object),
+                   numpy.array([e[1] for e in edges], dtype=numpy.int64),
+                   numpy.array([e[2] for e in edges], dtype=numpy.int64),
+                   numpy.array([e[3] for e in edges], dtype=numpy.float64))
+
+    def edges(self):
+        """Returns array of all edge indices."""
+
+        return numpy.arange(len(self.edgeIds))
+
+    def outEdgesOf(self, node):
+        """Returns array of indices of edges starting at node."""
+
+        return self.outEdges[self.outPointers[node]:
+                             self.outPointers[node + 1]]
+
+    def inEdgesOf(self, node):
+        """Returns array of indices of edges ending at node."""
+
+        return self.inEdges[self.inPointers[node]:self.inPointers[node + 1]]
+
+    def successors(self, node):
+        """Returns sorted array of nodes at the end of edges starting at
+           node."""
+
+        return numpy.unique(self.end[self.outEdgesOf(node)])
+
+    def predecessors(self, node):
+        """Returns sorted array of nodes at the start of edges ending at
+           node."""
+
+        return numpy.unique(self.start[self.inEdgesOf(node)])
+
+    def ancestors(self, node):
+        """Returns set of all other nodes with a path to node."""
+
+        found = set()
+        stack = [node]
+        while stack:
+            for p in self.predecessors(stack.pop()).tolist():
+                if p not in found:
+                    found.add(p)
+                    stack.append(p)
+        found.discard(node)
+
+        return found
+
+    def bifurcations(self):
+        """Returns boolean array, True for nodes with edges to more than one
+           other node."""
+
+        pairs = numpy.unique(
+            self.start.astype(numpy.int64) * len(self.nodeIds) + self.end
+        )
+
+        return numpy.bincount(pairs // len(self.nodeIds),
+                              minlength=len(self.nodeIds)) > 1
+
+    def topologicalOrder(self):
+        """Returns array of nodes ordered so that every edge starts before
+           it ends, or None if the graph contains cycles."""
+
+        inDegree = numpy.bincount(self.end, minlength=len(self.nodeIds))
+        inDegree = inDegree.tolist()
+        outPointers = self.outPointers.tolist()
+        outEdges = self.outEdges.tolist()
+        end = self.end.tolist()
+
+        order = [n for n, d in enumerate(inDegree) if d == 0]
+        queue = collections.deque(order)
+        while queue:
+            node = queue.popleft()
+            for e in outEdges[outPointers[node]:outPointers[node + 1]]:
+                inDegree[end[e]] -= 1
+                if inDegree[end[e]] == 0:
+                    order.append(end[e])
+                    queue.append(end[e])
+
+        if len(order) < len(self.nodeIds):
+            return None
+
+        return numpy.array(order, dtype=numpy.int64)
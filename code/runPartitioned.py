@@ -0,0 +1,346 @@
+import logging
+import argparse
+import collections
+import multiprocessing
+
+import numpy
+
+import flowStore
+import heatModel
+import riverGraph
+import graphSnapshot
+import buildRiverNetwork
+import calcUpstreamLength
+import calcHeatProduction
+import profiling
+
+
+def getEdgeEndpointArrays(cur, chunkSize=100000):
+    """Reads the first and last vertex of every river edge, a chunk of rows
+       at a time. Returns array of ROWIDs, and array of startX, startY,
+       endX and endY of each edge, ordered by ROWID."""
+
+    cur.execute("""SELECT ROWID, startX, startY, endX, endY
+                   FROM riverEdges
+                   ORDER BY ROWID;""")
+
+    rowIds = [numpy.zeros(0, dtype=numpy.int64)]
+    endpoints = [numpy.zeros((0, 4), dtype=numpy.float64)]
+    while True:
+        rows = cur.fetchmany(chunkSize)
+        if not rows:
+            break
+        rowIds.append(numpy.array([row[0] for row in rows],
+                                  dtype=numpy.int64))
+        endpoints.append(numpy.array([row[1:] for row in rows],
+                                     dtype=numpy.float64))
+
+    return numpy.concatenate(rowIds), numpy.concatenate(endpoints)
+
+
+def getCatchmentEdges(cur, rowIds, chunkSize=500):
+    """Reads endpoints, id and length of the river edges with ROWIDs in
+       sorted list rowIds. Returns list of edges in format of
+       [(rowId, (startX, startY), (endX, endY))], ordered by rowId, and
+       dictionary in format of {rowId: (id, length)}."""
+
+    edges = []
+    attributes = {}
+    for i in range(0, len(rowIds), chunkSize):
+        chunk = rowIds[i:i + chunkSize]
+        cur.execute("""SELECT ROWID, startX, startY, endX, endY, id,
+                       ST_Length(geometry)
+                       FROM riverEdges
+                       WHERE ROWID IN (%s)
+                       ORDER BY ROWID;"""
+                    % ", ".join(["?"] * len(chunk)), chunk)
+        for row in cur:
+            edges.append((row[0], (row[1], row[2]), (row[3], row[4])))
+            attributes[row[0]] = row[5:]
+
+    return edges, attributes
+
+
+def findCatchments(rowIds, endpoints, nodes):
+    """Splits river edges into catchments of edges connected through shared
+       endpoints, each seeded from the nodes at its outlets. rowIds and
+       endpoints are arrays as returned by getEdgeEndpointArrays and nodes
+       is list in format of [(nodeId, (x, y))]. Catchments without nodes
+       are left out. Edges are labelled with NumPy arrays, so only the
+       ROWIDs of each catchment's edges are kept. Returns list in format of
+       [(rowIds, nodes)], with rowIds a sorted array, keeping the order of
+       the nodes within each catchment."""
+
+    # Number every distinct endpoint coordinate
+    points = numpy.concatenate((
+        endpoints[:, 0:2], endpoints[:, 2:4],
+        numpy.array([coords for nodeId, coords in nodes],
+                    dtype=numpy.float64).reshape(len(nodes), 2)
+    ))
+    order = numpy.lexsort((points[:, 1], points[:, 0]))
+    distinct = numpy.r_[True, (points[order][1:] !=
+                               points[order][:-1]).any(axis=1)]
+    pointId = numpy.empty(len(points), dtype=numpy.int64)
+    pointId[order] = numpy.cumsum(distinct) - 1
+    start = pointId[:len(rowIds)]
+    end = pointId[len(rowIds):2 * len(rowIds)]
+    nodePoint = pointId[2 * len(rowIds):]
+    pointCount = int(distinct.sum())
+    del points, order, distinct, pointId
+
+    # Label connected points with the lowest point id, hooking the label of
+    # each edge's higher endpoint onto the lower until no edge joins two
+    label = numpy.arange(pointCount)
+    while True:
+        low = numpy.minimum(label[start], label[end])
+        high = numpy.maximum(label[start], label[end])
+        hook = low != high
+        if not hook.any():
+            break
+        numpy.minimum.at(label, high[hook], low[hook])
+        while True:
+            root = label[label]
+            if (root == label).all():
+                break
+            label = root
+
+    # Group edges by catchment label
+    edgeLabel = label[start]
+    order = numpy.argsort(edgeLabel, kind="mergesort")
+    seeds = numpy.unique(label[nodePoint])
+    bounds = numpy.searchsorted(edgeLabel[order],
+                                numpy.c_[seeds, seeds + 1]).tolist()
+
+    catchmentNodes = collections.defaultdict(list)
+    for i, c in enumerate(label[nodePoint].tolist()):
+        catchmentNodes[c].append(nodes[i])
+
+    return [(rowIds[order[first:last]], catchmentNodes[c])
+            for c, (first, last) in zip(seeds.tolist(), bounds)
+            if last > first]
+
+
+def processCatchment(task):
+    """Builds the river network of one catchment, calculates upstream
+       lengths, nearest gauged edges and heat production.
+
+       task is tuple of (edges, nodes, nextNodeId, attributes, gaugeFlows):
+       edges as returned by getCatchmentEdges, nodes as returned by
+       findCatchments, first id for new nodes, dictionary in format of
+       {rowId: (id, length)} and dictionary of mean monthly flows of gauged
+       edges in the catchment in format of {gaugedEdgeId: flows}.
+
+       Returns tuple of (newNodes, edgeNodes, edgeResults, heat), where
+       newNodes and edgeNodes are as returned by orientEdges, edgeResults
+       is list in format of [(id, nearestGaugedEdge, upstreamLengthRatio)]
+       and heat is tuple of (edgeIds, flow, heatMW, limitMW, annualGWh)."""
+
+    edges, nodes, nextNodeId, attributes, gaugeFlows = task
+
+    # Orient edges in direction of flow and create upstream nodes
+    newNodes, edgeNodes = buildRiverNetwork.orientEdges(edges, nodes,
+                                                        nextNodeId)
+
+    # Create graph of river nodes and edges
+    rowIds = [rowId for rowId, start, end in edges if rowId in edgeNodes]
+    G = riverGraph.RiverGraph(
+        sorted(set([n[0] for n in nodes] + [n[0] for n in newNodes])),
+        numpy.array([attributes[r][0] for r in rowIds], dtype=object),
+        numpy.array([edgeNodes[r][0] for r in rowIds], dtype=numpy.int64),
+        numpy.array([edgeNodes[r][1] for r in rowIds], dtype=numpy.int64),
+        numpy.array([attributes[r][1] for r in rowIds], dtype=numpy.float64)
+    )
+
+    # Calculate upstream lengths and find nearest gauged edges
+    calcUpstreamLength.calcUpstreamLengths(G)
+    calcUpstreamLength.assignNearestGaugedEdges(G, gaugeFlows.keys())
+
+    edgeIds = G.edgeIds.tolist()
+    edgeResults = [
+        (edgeIds[e], edgeIds[G.nearestGaugedEdge[e]],
+         float(G.upstreamLengthRatio[e]))
+        for e in numpy.nonzero(G.nearestGaugedEdge >= 0)[0].tolist()
+    ]
+
+    # Calculate heat production of edges with a gauged flow
+    edgeResults.sort()
+    heatEdges = [r for r in edgeResults if not numpy.isnan(r[2])]
+    gauges = sorted(set(r[1] for r in heatEdges))
+    gaugeIndex = dict((g, i) for i, g in enumerate(gauges))
+    lengths = dict(attributes.values())
+    inputs = heatModel.HeatInputs(
+        [r[0] for r in heatEdges],
+        None,
+        numpy.array([gaugeIndex[r[1]] for r in heatEdges], dtype=numpy.int64),
+        numpy.array([r[2] for r in heatEdges], dtype=numpy.float64),
+        numpy.array([lengths[r[0]] for r in heatEdges], dtype=numpy.float64),
+        gauges, None, None, None, None, None
+    )
+    gaugeFlows = numpy.array([gaugeFlows[g] for g in gauges],
+                             dtype=numpy.float64).reshape(len(gauges), 12)
+    flow, heatMW, limitMW, annualGWh = heatModel.calcHeat(
+        inputs, gaugeFlows=gaugeFlows
+    )
+
+    return (newNodes, edgeNodes, edgeResults,
+            (inputs.edgeIds, flow, heatMW, limitMW, annualGWh))
+
+
+def getGaugeFlows(cur, store):
+    """Calculates mean flow of each calendar month at every gauged edge.
+       Returns dictionary in format of {gaugedEdgeId: flows}."""
+
+    cur.execute("""SELECT id
+                   FROM riverEdges
+                   WHERE id IN
+                   (SELECT riverId FROM nrfaStations);""")
+    gauges = sorted(row[0] for row in cur)
+
+    inputs = heatModel.HeatInputs(
+        None, None, None, None, None, gauges,
+        *heatModel.loadStations(cur, gauges, store)
+    )
+    flows = heatModel.calcGaugeMonthlyFlows(inputs, heatModel.defaultStart,
+                                            heatModel.defaultEnd)
+
+    return dict(zip(gauges, flows.tolist()))
+
+
+def generateTasks(cur, catchments, gaugeFlows, nextNodeId):
+    """Yields processCatchment tasks for catchments, largest first, reading
+       the edges of each catchment as its task is requested. Each catchment
+       takes new node ids from its own range, one per edge."""
+
+    firstNodeIds = []
+    for rowIds, nodes in catchments:
+        firstNodeIds.append(nextNodeId)
+        nextNodeId += len(rowIds)
+
+    order = sorted(range(len(catchments)),
+                   key=lambda c: len(catchments[c][0]), reverse=True)
+    for c in order:
+        rowIds, nodes = catchments[c]
+        edges, catchmentAttributes = getCatchmentEdges(cur, rowIds.tolist())
+        catchmentGaugeFlows = dict(
+            (a[0], gaugeFlows[a[0]]) for a in catchmentAttributes.values()
+            if a[0] in gaugeFlows
+        )
+        yield (edges, nodes, firstNodeIds[c], catchmentAttributes,
+               catchmentGaugeFlows)
+
+
+def imapBounded(pool, func, tasks, window):
+    """Yields results of func for each of tasks, run in pool, in the order
+       of tasks. Tasks are read in the calling thread, with at most window
+       tasks queued or running at once."""
+
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Builds the river network and calculates heat "
+                    "production one catchment at a time, in parallel."
+    )
+    parser.add_argument("--processes", type=int, metavar="N",
+                        help="number of worker processes, default: number "
+                             "of CPUs")
+    parser.add_argument("--flow-store", metavar="DIR",
+                        help="read flows from columnar store in DIR")
+    args = parser.parse_args()
+
+    # Logging set-up
+    logging.basicConfig(format="%(asctime)s|%(levelname)s|%(message)s",
+                        level=logging.INFO)
+
+    # Database path
+    sqliteDb = "../results/results.sqlite"
+
+    # Graph snapshot path
+    graphSnapshotDir = "../results/riverGraph"
+
+    # Connect to database
+    logging.info("Connecting to database")
+    db = profiling.connect(sqliteDb)
+    try:
+        db.enable_load_extension(True)
+        db.load_extension("mod_spatialite")
+        cur = db.cursor()
+        cur.execute("SELECT InitSpatialMetaData();")
+
+        # Create river edges and coastal nodes
+        logging.info("Creating river edges and coastal nodes")
+        profiling.stage("createRiverEdges")
+        buildRiverNetwork.createRiverEdges(cur)
+        buildRiverNetwork.createRiverNodes(cur)
+
+        # Split river edges into catchments
+        logging.info("Finding catchments")
+        profiling.stage("findCatchments")
+        rowIds, endpoints = getEdgeEndpointArrays(cur)
+        catchments = findCatchments(rowIds, endpoints,
+                                    buildRiverNetwork.getNodeCoords(cur))
+        del rowIds, endpoints
+        logging.info("Found %d catchments" % len(catchments))
+
+        # Read gauged flows
+        profiling.stage("readFlows")
+        if args.flow_store is not None:
+            store = flowStore.FlowStore.load(args.flow_store)
+        else:
+            store = flowStore.FlowStore.fromDatabase(cur)
+        gaugeFlows = getGaugeFlows(cur, store)
+        walesEdgeIds = heatModel.getWalesEdgeIds(cur)
+        nextNodeId = cur.execute("""SELECT IFNULL(MAX(id), 0) + 1
+                                    FROM riverNodes;""").fetchone()[0]
+
+        # Process catchments in parallel, writing the results of each in turn
+        profiling.stage("processCatchments")
+        calcHeatProduction.createMonthlyFlowRates(cur)
+        calcHeatProduction.createAnnualHeat(cur)
+        processes = args.processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        try:
+            tasks = generateTasks(cur, catchments, gaugeFlows, nextNodeId)
+            for i, result in enumerate(imapBounded(pool, processCatchment,
+                                                   tasks, 2 * processes)):
+                newNodes, edgeNodes, edgeResults, heat = result
+                edgeIds, flow, heatMW, limitMW, annualGWh = heat
+                buildRiverNetwork.writeOrientation(cur, newNodes, edgeNodes)
+                calcUpstreamLength.writeEdgeResults(cur, edgeResults,
+                                                    clear=False)
+                calcHeatProduction.writeMonthlyFlowRates(cur, edgeIds, flow,
+                                                         heatMW, limitMW)
+                calcHeatProduction.writeAnnualHeat(cur, edgeIds, annualGWh,
+                                                   walesEdgeIds)
+                logging.info("Processed catchment %d of %d"
+                             % (i + 1, len(catchments)))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        # Create spatial index of annual heat
+        profiling.stage("createSpatialIndex")
+        cur.execute("SELECT CreateSpatialIndex('annualHeat', 'geometry');")
+
+        # Calculate annual heat production for lakes
+        logging.info("Calculating heat production of lakes")
+        profiling.stage("annualHeatLakes")
+        calcHeatProduction.calcLakeHeat(cur)
+
+        # Commit changes
+        db.commit()
+
+        # Save graph snapshot for calcUpstreamLength.py
+        profiling.stage("writeGraphSnapshot")
+        graphSnapshot.writeGraphSnapshot(cur, graphSnapshotDir)
+
+    finally:
+        db.close()
@@ -0,0 +1,300 @@
+import sqlite3
+import os
+import ast
+import glob
+import json
+import hashlib
+import logging
+import argparse
+import subprocess
+import sys
+import datetime
+
+# Database path
+sqliteDb = "../results/results.sqlite"
+
+# Pipeline stages in run order. Each stage lists the input file patterns it
+# reads, the stage outputs it depends on, and queries whose results
+# fingerprint its own outputs. An output with no query changes whenever the
+# stage is rerun.
+stages = [
+    {"name": "readOSMeridian2",
+     "script": "readOSMeridian2.py",
+     "inputs": ["../data/meridian2_national_841398/district_region.*",
+                "../data/meridian2_national_841398/river_polyline.*",
+                "../data/meridian2_national_841398/coast_ln_polyline.*",
+                "../data/meridian2_national_841398/lake_region.*"],
+     "dependsOn": [],
+     "outputs": {"meridian2": None}},
+    {"name": "buildRiverNetwork",
+     "script": "buildRiverNetwork.py",
+     "inputs": [],
+     "dependsOn": ["readOSMeridian2.meridian2"],
+     "outputs": {"riverNetwork": None}},
+    {"name": "readFlowData",
+     "script": "readFlowData.py",
+     "inputs": ["../data/nrfa/NRFA Flow Data Retrieval/*.csv",
+                "../data/riverStationLookup.csv"],
+     "dependsOn": [],
+     "outputs": {"gaugedRivers": """SELECT DISTINCT riverId
+                                    FROM nrfaStations
+                                    WHERE riverId IS NOT NULL
+                                    ORDER BY riverId;""",
+                 "stationRivers": """SELECT id, riverId
+                                     FROM nrfaStations
+                                     ORDER BY id;""",
+                 "flows": """SELECT station, dataType, month, flow
+                             FROM nrfaGmf
+                             ORDER BY station, dataType, month;""",
+                 "records": """SELECT station, dataType, first, last
+                               FROM nrfaData
+                               ORDER BY station, dataType;""",
+                 "stations": None}},
+    {"name": "snapStations",
+     "script": "snapStations.py",
+     "inputs": ["../data/riverStationLookup.csv"],
+     "dependsOn": ["buildRiverNetwork.riverNetwork",
+                   "readFlowData.stations"],
+     "outputs": {"gaugedRivers": """SELECT DISTINCT riverId
+                                    FROM nrfaStations
+                                    WHERE riverId IS NOT NULL
+                                    ORDER BY riverId;""",
+                 "stationRivers": """SELECT id, riverId
+                                     FROM nrfaStations
+                                     ORDER BY id;"""}},
+    {"name": "calcUpstreamLength",
+     "script": "calcUpstreamLength.py",
+     "inputs": [],
+     "dependsOn": ["buildRiverNetwork.riverNetwork",
+                   "snapStations.gaugedRivers"],
+     "outputs": {"upstreamLengthRatios": """SELECT id, nearestGaugedEdge,
+                                                   upstreamLengthRatio
+                                            FROM riverEdges
+                                            ORDER BY id;"""}},
+    {"name": "calcHeatProduction",
+     "script": "calcHeatProduction.py",
+     "inputs": [],
+     "dependsOn": ["readOSMeridian2.meridian2",
+                   "calcUpstreamLength.upstreamLengthRatios",
+                   "snapStations.stationRivers",
+                   "readFlowData.flows",
+                   "readFlowData.records"],
+     "outputs": {"annualHeat": None}},
+    {"name": "buildHeatTiles",
+     "script": "buildHeatTiles.py",
+     "inputs": [],
+     "dependsOn": ["calcHeatProduction.annualHeat"],
+     "outputs": {"heatTiles": None}}
+]
+
+
+def createMetadataTables(cur):
+    """Creates tables recording pipeline stage runs and input file hashes,
+       if they don't already exist."""
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS pipelineStages (
+                   stage TEXT PRIMARY KEY,
+                   signature TEXT,
+                   inputs TEXT,
+                   outputs TEXT,
+                   completed TEXT);""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS pipelineFiles (
+                   path TEXT PRIMARY KEY,
+                   size INTEGER,
+                   modified REAL,
+                   hash TEXT);""")
+
+
+def hashFile(cur, path):
+    """Returns SHA-1 hash of file contents. Hashes are cached in the
+       pipelineFiles table and only recalculated if the file size or
+       modification time has changed."""
+
+    path = os.path.abspath(path)
+    size = os.path.getsize(path)
+    modified = os.path.getmtime(path)
+    row = cur.execute("""SELECT hash
+                         FROM pipelineFiles
+                         WHERE path = ?
+                         AND size = ?
+                         AND modified = ?;""",
+                      (path, size, modified)).fetchone()
+    if row is not None:
+        return row[0]
+
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    cur.execute("INSERT OR REPLACE INTO pipelineFiles VALUES (?, ?, ?, ?);",
+                (path, size, modified, h.hexdigest()))
+
+    return h.hexdigest()
+
+
+def hashQuery(cur, sql):
+    """Returns SHA-1 hash of all rows returned by query."""
+
+    h = hashlib.sha1()
+    for row in cur.execute(sql):
+        h.update(repr(tuple(
+            str(v) if isinstance(v, buffer) else v for v in row
+        )))
+
+    return h.hexdigest()
+
+
+def localModules(script):
+    """Returns sorted list of paths of the modules in the script's directory
+       that it imports, directly or through other local modules."""
+
+    directory = os.path.dirname(os.path.abspath(script))
+    found = set([os.path.abspath(script)])
+    pending = [os.path.abspath(script)]
+    while pending:
+        with open(pending.pop()) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                path = os.path.join(directory, name.split(".")[0] + ".py")
+                if path not in found and os.path.exists(path):
+                    found.add(path)
+                    pending.append(path)
+    found.remove(os.path.abspath(script))
+
+    return sorted(found)
+
+
+def getInputHashes(cur, stage):
+    """Returns dictionary in format of {path: hash} for all files matching
+       the stage input patterns."""
+
+    hashes = {}
+    for pattern in stage["inputs"]:
+        for path in sorted(glob.glob(pattern)):
+            hashes[path] = hashFile(cur, path)
+
+    return hashes
+
+
+def getStageRecord(cur, name):
+    """Returns (signature, outputs) recorded for the last completed run of
+       stage, or (None, {}) if it has never been run."""
+
+    row = cur.execute("""SELECT signature, outputs
+                         FROM pipelineStages
+                         WHERE stage = ?;""", (name,)).fetchone()
+    if row is None:
+        return None, {}
+
+    return row[0], json.loads(row[1])
+
+
+def calcSignature(cur, stage, inputHashes):
+    """Returns hash of everything a stage's results depend on: its script
+       and the local modules it imports, its input files and the outputs of
+       the stages it depends on. Returns None if a stage it depends on has
+       not been run."""
+
+    h = hashlib.sha1()
+    h.update(stage["name"])
+    h.update(hashFile(cur, stage["script"]))
+    for path in localModules(stage["script"]):
+        h.update(os.path.basename(path) + hashFile(cur, path))
+    for path in sorted(inputHashes):
+        h.update(os.path.basename(path) + inputHashes[path])
+    for dependency in sorted(stage["dependsOn"]):
+        stageName, outputName = dependency.split(".")
+        outputs = getStageRecord(cur, stageName)[1]
+        if outputs.get(outputName) is None:
+            return None
+        h.update(dependency + outputs[outputName])
+
+    return h.hexdigest()
+
+
+def runStage(db, stage, force=False, dryRun=False):
+    """Runs stage script if its signature has changed since it was last
+       run. Records the new signature and output fingerprints. Returns True
+       if the stage was run."""
+
+    cur = db.cursor()
+    inputHashes = getInputHashes(cur, stage)
+    signature = calcSignature(cur, stage, inputHashes)
+    db.commit()
+
+    if not force and signature is not None and \
+            signature == getStageRecord(cur, stage["name"])[0]:
+        logging.info("Skipping %s, inputs unchanged", stage["name"])
+        return False
+
+    logging.info("Running %s", stage["name"])
+    if dryRun:
+        return True
+
+    # Forget the previous run in case this one fails part way through
+    cur.execute("DELETE FROM pipelineStages WHERE stage = ?;",
+                (stage["name"],))
+    db.commit()
+
+    subprocess.check_call([sys.executable, stage["script"]])
+
+    outputs = {}
+    for outputName, sql in stage["outputs"].iteritems():
+        if sql is None:
+            outputs[outputName] = signature
+        else:
+            outputs[outputName] = hashQuery(cur, sql)
+
+    cur.execute("""INSERT OR REPLACE INTO pipelineStages
+                   VALUES (?, ?, ?, ?, ?);""",
+                (stage["name"], signature, json.dumps(inputHashes),
+                 json.dumps(outputs), datetime.datetime.now().isoformat()))
+    db.commit()
+
+    return True
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Runs the pipeline stages whose inputs have changed."
+    )
+    parser.add_argument("--force", nargs="+", default=[], metavar="STAGE",
+                        help="rerun stages even if inputs are unchanged")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="list the stages that would be run")
+    args = parser.parse_args()
+
+    # Logging set-up
+    logging.basicConfig(format="%(asctime)s|%(levelname)s|%(message)s",
+                        level=logging.INFO)
+
+    # Scripts use paths relative to the code directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    db = sqlite3.connect(sqliteDb)
+    try:
+        createMetadataTables(db.cursor())
+        db.commit()
+
+        # Stages run, or that would be run in a dry run
+        runStages = set()
+        for stage in stages:
+            force = stage["name"] in args.force
+            if args.dry_run:
+                # Outputs of stages that would be run are unknown
+                force = force or any(
+                    d.split(".")[0] in runStages for d in stage["dependsOn"]
+                )
+            if runStage(db, stage, force, args.dry_run):
+                runStages.add(stage["name"])
+
+    finally:
+        db.close()
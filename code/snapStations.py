@@ -0,0 +1,218 @@
+import math
+import logging
+import argparse
+
+import numpy
+import shapely.wkb
+
+import heatQuery
+import riverGraph
+import graphSnapshot
+import readFlowData
+import calcUpstreamLength
+import profiling
+
+
+def getStations(cur):
+    """Reads gauging station coordinates and precisions. Returns array of
+       station ids, and arrays of easting, northing and precision of the
+       south west corner of each station's grid reference square."""
+
+    cur.execute("""SELECT id, ST_X(geometry), ST_Y(geometry), geomPrecision
+                   FROM nrfaStations
+                   WHERE geometry IS NOT NULL
+                   AND geomPrecision IS NOT NULL
+                   ORDER BY id;""")
+    stations = cur.fetchall()
+
+    return (numpy.array([s[0] for s in stations], dtype=numpy.int64),
+            numpy.array([s[1] for s in stations], dtype=numpy.float64),
+            numpy.array([s[2] for s in stations], dtype=numpy.float64),
+            numpy.array([s[3] for s in stations], dtype=numpy.float64))
+
+
+def getEdgeGeometries(cur, snapshot=None):
+    """Returns list of Shapely geometries of river edges with start and end
+       nodes, in the order of riverGraph.RiverGraph edges. Geometries are
+       read from graphSnapshot.GraphSnapshot snapshot if given."""
+
+    if snapshot is not None:
+        return [snapshot.geometry(i) for i in range(snapshot.edgeCount)]
+
+    cur.execute("""SELECT ST_AsBinary(geometry)
+                   FROM riverEdges
+                   WHERE startNodeId IS NOT NULL
+                   AND endNodeId IS NOT NULL
+                   ORDER BY ROWID;""")
+
+    return [shapely.wkb.loads(str(row[0])) for row in cur]
+
+
+def snapStations(index, upstreamLength, x, y, precisions, tolerance=50.0,
+                 plausibilityWeight=0.5):
+    """Finds the river edge each station is most likely on, from edges
+       within the station's grid reference square and tolerance. Candidates
+       are ranked by score: distance from the centre of the square as a
+       fraction of the search radius, plus plausibilityWeight times the
+       log10 ratio of the largest candidate upstream length to the edge's
+       own, as stations are usually on the main river.
+
+       index is heatQuery.HeatIndex of the river edges, upstreamLength array
+       of upstream length of each edge, and x, y and precisions arrays of
+       the south west corner and size of each station's square. Returns
+       arrays of edge index (-1 if none), distance and score of each
+       station."""
+
+    # Search each precision of grid reference at once
+    centreX = x + precisions / 2.0
+    centreY = y + precisions / 2.0
+    radii = precisions * math.sqrt(0.5) + tolerance
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    stations, edges, distances = [empty], [empty], [numpy.zeros(0)]
+    for radius in numpy.unique(radii).tolist():
+        group = numpy.nonzero(radii == radius)[0]
+        p, e, d = index.within(centreX[group], centreY[group], radius)
+        if len(p) == 0:
+            continue
+        stations.append(group[p])
+        edges.append(e)
+        distances.append(d)
+    stations = numpy.concatenate(stations)
+    edges = numpy.concatenate(edges)
+    distances = numpy.concatenate(distances)
+
+    edge = numpy.full(len(x), -1, dtype=numpy.int64)
+    distance = numpy.full(len(x), numpy.nan)
+    score = numpy.full(len(x), numpy.nan)
+    if len(stations) == 0:
+        return edge, distance, score
+
+    # Score candidates against the largest upstream length of each station
+    order = numpy.argsort(stations, kind="mergesort")
+    stations = stations[order]
+    edges = edges[order]
+    distances = distances[order]
+    starts = numpy.nonzero(numpy.r_[True, stations[1:] != stations[:-1]])[0]
+    lengths = upstreamLength[edges]
+    largest = numpy.repeat(numpy.maximum.reduceat(lengths, starts),
+                           numpy.diff(numpy.r_[starts, len(stations)]))
+    scores = (distances / radii[stations] +
+              plausibilityWeight * numpy.log10(largest / lengths))
+
+    # Best scoring candidate of each station
+    order = numpy.lexsort((scores, stations))
+    best = order[numpy.r_[True, stations[order][1:] !=
+                          stations[order][:-1]]]
+    edge[stations[best]] = edges[best]
+    distance[stations[best]] = distances[best]
+    score[stations[best]] = scores[best]
+
+    return edge, distance, score
+
+
+def writeStationSnaps(cur, rows):
+    """Creates stationSnaps table from rows in format of
+       [(station, riverId, distance, score, source)], and sets the river id
+       of every gauging station from it."""
+
+    cur.execute("DROP TABLE IF EXISTS stationSnaps;")
+    cur.execute("""CREATE TABLE stationSnaps (
+                   station INTEGER PRIMARY KEY,
+                   riverId TEXT,
+                   distance REAL,
+                   score REAL,
+                   source TEXT);""")
+    cur.executemany("INSERT INTO stationSnaps VALUES (?, ?, ?, ?, ?);", rows)
+    cur.execute("""UPDATE nrfaStations
+                   SET riverId =
+                   (SELECT riverId
+                   FROM stationSnaps
+                   WHERE station = nrfaStations.id);""")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Snaps gauging stations to river edges within their grid "
+                    "reference squares. Stations in the manual lookup table "
+                    "keep their river id."
+    )
+    parser.add_argument("--tolerance", type=float, default=50.0,
+                        help="distance searched beyond each station's grid "
+                             "reference square, units: meters, default: 50")
+    parser.add_argument("--ignore-lookup", action="store_true",
+                        help="snap every station, ignoring the manual lookup "
+                             "table")
+    args = parser.parse_args()
+
+    # Logging set-up
+    logging.basicConfig(format="%(asctime)s|%(levelname)s|%(message)s",
+                        level=logging.INFO)
+
+    # Input paths
+    lookupCsv = "../data/riverStationLookup.csv"
+
+    # Database path
+    sqliteDb = "../results/results.sqlite"
+
+    # Graph snapshot path
+    graphSnapshotDir = "../results/riverGraph"
+
+    # Connect to database
+    logging.info("Connecting to database")
+    db = profiling.connect(sqliteDb)
+    try:
+        db.enable_load_extension(True)
+        db.load_extension("mod_spatialite")
+        cur = db.cursor()
+
+        # Create graph of river nodes and edges, with upstream lengths
+        profiling.stage("createGraph")
+        if graphSnapshot.isCurrent(cur, graphSnapshotDir):
+            snapshot = graphSnapshot.GraphSnapshot(graphSnapshotDir)
+            G = riverGraph.RiverGraph.fromSnapshot(snapshot)
+        else:
+            snapshot = None
+            G = riverGraph.RiverGraph.fromDatabase(cur)
+        calcUpstreamLength.calcUpstreamLengths(G)
+
+        # Index river edges
+        logging.info("Indexing river edges")
+        profiling.stage("indexEdges")
+        edgeIds = G.edgeIds.tolist()
+        index = heatQuery.HeatIndex([
+            ("riverEdges", edgeId, numpy.nan, geometry)
+            for edgeId, geometry in zip(edgeIds,
+                                        getEdgeGeometries(cur, snapshot))
+        ])
+
+        # Snap stations to river edges
+        logging.info("Snapping stations")
+        profiling.stage("snapStations")
+        stationIds, x, y, precisions = getStations(cur)
+        edge, distance, score = snapStations(index, G.upstreamLength, x, y,
+                                             precisions, args.tolerance)
+        manual = {} if args.ignore_lookup else \
+            readFlowData.getRiverIDs(lookupCsv)
+
+        rows = []
+        for i, stationId in enumerate(stationIds.tolist()):
+            if str(stationId) in manual:
+                rows.append((stationId, manual[str(stationId)], None, None,
+                             "manual"))
+            elif edge[i] >= 0:
+                rows.append((stationId, edgeIds[edge[i]], distance[i],
+                             score[i], "snapped"))
+        logging.info("Found rivers of %d of %d stations, %d from lookup "
+                     "table"
+                     % (len(rows), len(stationIds),
+                        sum(r[4] == "manual" for r in rows)))
+
+        profiling.stage("writeStationSnaps")
+        writeStationSnaps(cur, rows)
+
+        # Commit changes
+        db.commit()
+
+    finally:
+        db.close()